@@ -0,0 +1,235 @@
+"""Travel time analytics on Moscow metro graph."""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import shortest_path
+
+
+class MetroGraph(object):
+    """
+    A class used to calculate travel times between metro stations.
+
+    Metro network is stored as a sparse CSR matrix with travel times in minutes on edges.
+    Edge times are taken from time_column of connections if it is given. Otherwise time is estimated from
+    distance between stations and average speed, connections between stations on different lines are
+    transfers and get fixed time.
+    All-pairs shortest paths are calculated once and cached as .npy file, which is opened as memmap,
+    so queries don't need to recalculate anything.
+
+    Methods
+    -------
+    travel_time(origins, destinations)
+        Travel times for arrays of station ids
+    catchment(station_id, max_time)
+        Stations reachable from a station in given time
+    reachability(max_time)
+        Number of stations reachable from every station in given time
+    od_flows(origins, destinations)
+        Number of trips and travel time for every pair of stations
+
+    Example:
+    --------
+    >>>metro_data = MetroData(no_process=True)
+    >>>metro_graph = MetroGraph(metro_data.connections, metro_data.stations, cache_path='cache')
+    >>>metro_graph.travel_time(home_station_ids, work_station_ids)
+    """
+
+    def __init__(self, connections, stations, speed=40, stop_time=0.5, transfer_time=3, cache_path='',
+                 time_column=None):
+        """
+        Parameters:
+        -----------
+        connections, stations : pd.DataFrame()
+            data from metro class
+        speed : float
+            average train speed in km/h
+        stop_time : float
+            time of one stop in minutes
+        transfer_time : float
+            time of one transfer in minutes
+        cache_path : str
+            folder for cached shortest paths matrix
+        time_column : str
+            column of connections with travel times in minutes, times are estimated if None
+        """
+        self.speed = speed
+        self.stop_time = stop_time
+        self.transfer_time = transfer_time
+        self.cache_path = cache_path
+        self.time_column = time_column
+
+        self.station_ids = pd.Index(stations['id'].values)
+        self.stations = stations.reset_index(drop=True)
+        self.graph = self._build_graph(connections)
+        self._paths = None
+
+    def _build_graph(self, connections):
+        """Create symmetric CSR matrix with travel times."""
+        ind1 = self._get_indices(connections['station1'].values)
+        ind2 = self._get_indices(connections['station2'].values)
+
+        if self.time_column is not None:
+            time = connections[self.time_column].values.astype(np.float32)
+        else:
+            time = self._estimate_time(ind1, ind2)
+
+        row = np.concatenate([ind1, ind2])
+        col = np.concatenate([ind2, ind1])
+        time = np.concatenate([time, time])
+
+        # scipy sums duplicated connections, keep the fastest one instead
+        order = np.lexsort((time, col, row))
+        row, col, time = row[order], col[order], time[order]
+        first = np.ones(len(row), dtype=bool)
+        first[1:] = (row[1:] != row[:-1]) | (col[1:] != col[:-1])
+
+        n = len(self.station_ids)
+        return sparse.csr_matrix((time[first], (row[first], col[first])), shape=(n, n))
+
+    def _estimate_time(self, ind1, ind2):
+        """Estimate travel time between connected stations in minutes."""
+        lat = np.radians(self.stations['latitude'].values.astype(float))
+        lon = np.radians(self.stations['longitude'].values.astype(float))
+
+        # haversine distance in km
+        a = (np.sin((lat[ind2] - lat[ind1]) / 2) ** 2 +
+             np.cos(lat[ind1]) * np.cos(lat[ind2]) * np.sin((lon[ind2] - lon[ind1]) / 2) ** 2)
+        distance = 2 * 6371 * np.arcsin(np.sqrt(a))
+
+        line = self.stations['line'].values
+        time = np.where(line[ind1] != line[ind2], self.transfer_time,
+                        distance / self.speed * 60 + self.stop_time)
+
+        return time.astype(np.float32)
+
+    def _get_indices(self, station_ids):
+        """Convert station ids into matrix indices."""
+        indices = self.station_ids.get_indexer(np.asarray(station_ids))
+        if (indices < 0).any():
+            raise ValueError('Unknown station ids!')
+
+        return indices
+
+    def _cache_file_name(self):
+        """File name depends on graph structure and edge times, so changed graph isn't read from old cache."""
+        digest = hashlib.md5()
+        for array in (self.graph.indptr, self.graph.indices, self.graph.data):
+            digest.update(np.ascontiguousarray(array).tobytes())
+
+        return os.path.join(self.cache_path, f'metro_paths_{digest.hexdigest()[:16]}.npy')
+
+    @property
+    def paths(self):
+        """All-pairs shortest travel times, calculated once and then read from cache."""
+        if self._paths is None:
+            file_name = self._cache_file_name()
+            if not os.path.exists(file_name):
+                distances = shortest_path(self.graph, method='D', directed=False)
+                if self.cache_path:
+                    os.makedirs(self.cache_path, exist_ok=True)
+                # matrix is written to a temporary file and renamed, so interrupted run doesn't leave broken cache
+                fd, temp_name = tempfile.mkstemp(suffix='.npy', dir=self.cache_path or '.')
+                os.close(fd)
+                try:
+                    paths = np.lib.format.open_memmap(temp_name, mode='w+', dtype=np.float32,
+                                                      shape=distances.shape)
+                    paths[:] = distances
+                    paths.flush()
+                    del paths
+                    os.replace(temp_name, file_name)
+                except BaseException:
+                    os.remove(temp_name)
+                    raise
+
+            self._paths = np.load(file_name, mmap_mode='r')
+
+        return self._paths
+
+    def travel_time(self, origins, destinations):
+        """
+        Get travel times between stations.
+
+        Parameters:
+        -----------
+        origins, destinations : array-like
+            station ids of the same length
+
+        Returns:
+        -------
+        np.ndarray of travel times in minutes, np.inf for unreachable stations
+        """
+        return self.paths[self._get_indices(origins), self._get_indices(destinations)]
+
+    def catchment(self, station_id, max_time):
+        """
+        Get stations reachable from a station.
+
+        Parameters:
+        -----------
+        station_id : int
+            station id
+        max_time : float
+            maximum travel time in minutes
+
+        Returns:
+        -------
+        pd.DataFrame of stations with travel time
+        """
+        times = np.asarray(self.paths[self._get_indices([station_id])[0]])
+        indices = np.flatnonzero(times <= max_time)
+        result = self.stations.iloc[indices].copy()
+        result['time'] = times[indices]
+
+        return result.sort_values('time')
+
+    def reachability(self, max_time, chunk_size=1024):
+        """
+        Get number of stations reachable from every station.
+
+        Parameters:
+        -----------
+        max_time : float
+            maximum travel time in minutes
+        chunk_size : int
+            number of matrix rows read at once
+
+        Returns:
+        -------
+        pd.Series indexed by station id
+        """
+        paths = self.paths
+        counts = np.empty(paths.shape[0], dtype=np.int64)
+        for start in range(0, paths.shape[0], chunk_size):
+            counts[start:start + chunk_size] = (paths[start:start + chunk_size] <= max_time).sum(axis=1)
+
+        return pd.Series(counts, index=self.station_ids, name='reachable_stations')
+
+    def od_flows(self, origins, destinations):
+        """
+        Aggregate trips between stations, e.g. home and work stations of subscribers.
+
+        Parameters:
+        -----------
+        origins, destinations : array-like
+            station ids of the same length, one pair per subscriber
+
+        Returns:
+        -------
+        pd.DataFrame with columns station1, station2, trips, time
+        """
+        ind1 = self._get_indices(origins)
+        ind2 = self._get_indices(destinations)
+        n = len(self.station_ids)
+
+        flows = sparse.coo_matrix((np.ones(len(ind1), dtype=np.int64), (ind1, ind2)), shape=(n, n)).tocsr()
+        flows.sum_duplicates()
+        flows = flows.tocoo()
+
+        return pd.DataFrame({'station1': self.station_ids.values[flows.row],
+                             'station2': self.station_ids.values[flows.col],
+                             'trips': flows.data,
+                             'time': self.paths[flows.row, flows.col]})
@@ -5,16 +5,14 @@ import numpy as np
 import colorsys
 import networkx as nx
 from bokeh.resources import CDN
-from bokeh.io import output_notebook
+from bokeh.io import output_notebook, show
+from bokeh.models import ColumnDataSource, CustomJS, Slider
+from bokeh.layouts import column
+from bokeh.plotting import figure, output_file, save
 output_notebook(resources=CDN)
 
 pd.set_option('max_colwidth', 200)
 pd.set_option('max_rows', 500)
-from bokeh.plotting import figure, output_file, show, ColumnDataSource, save
-
-from bokeh.io import show
-from bokeh.models import ColumnDataSource
-from bokeh.plotting import figure
 
 
 def _pseudocolor(val):
@@ -36,6 +34,97 @@ def _rgb2hex(color):
     return f"#{''.join(f'{hex(c)[2:].upper():0>2}' for c in color)}"
 
 
+def _station_table(data, columns):
+    """
+    Builds a table of station attributes indexed by (display_name, line).
+
+    Parameters:
+    -----------
+    data : pd.DataFrame()
+        data prepared by metro class
+    columns : list of strings
+        columns to keep, duplicates are dropped
+
+    Returns:
+    -------
+    pd.DataFrame indexed by (display_name, line), first row is kept for duplicated stations
+    """
+    columns = list(dict.fromkeys(columns))
+    table = data[['display_name', 'line'] + columns].copy()
+    table['line'] = table['line'].astype(int)
+    return table.drop_duplicates(['display_name', 'line']).set_index(['display_name', 'line'])
+
+
+def _build_graph(connections, stations):
+    """
+    Creates metro graph and station layout.
+
+    Parameters:
+    -----------
+    connections, stations - data from metro class
+
+    Returns:
+    -------
+    graph : networkx graph
+    locations : dictionary of stations and normalized coordinates
+    nodes : pd.DataFrame() of stations indexed by node name in the order of graph.nodes()
+    """
+    # inputs are shared with other users of metro data and are not changed
+    connections = connections.copy()
+    stations = stations.copy()
+    stations['node_name'] = stations['name'] + '_' + stations['line'].astype(str)
+    connections['time'] = 1
+    node_names = stations['node_name'].values
+    graph = nx.Graph()
+    graph.add_edges_from(
+        (station1_name, station2_name, {'time': time})
+        for station1_name, station2_name, time in zip(node_names[connections['station1'].values - 1],
+                                                      node_names[connections['station2'].values - 1],
+                                                      connections['time'].values))
+
+    normed = stations[['longitude', 'latitude']]
+    normed = normed - normed.min()
+    normed = normed / normed.max()
+    locations = dict(zip(stations['node_name'], normed[['longitude', 'latitude']].values))
+
+    nodes = stations.drop_duplicates('node_name').set_index('node_name').reindex(list(graph.nodes()))
+
+    return graph, locations, nodes
+
+
+def _node_attributes(nodes, data, radius_feature, color_feature, features):
+    """
+    Calculates data dependent node attributes.
+
+    Parameters:
+    -----------
+    nodes : pd.DataFrame()
+        stations from _build_graph
+    data, radius_feature, color_feature, features - see _prepare_data
+
+    Returns:
+    -------
+    dictionary of columns for ColumnDataSource, rows are in the order of nodes.
+    Stations without data get grey color.
+    """
+    # attributes are taken from a (name, line)-indexed table instead of filtering per node
+    node_table = _station_table(data, [radius_feature, color_feature, 'scaled_user_count'] + list(features))
+    node_table = node_table.reindex(pd.MultiIndex.from_arrays([nodes['name'].values, nodes['line'].values]))
+
+    attributes = dict(
+        radius=np.clip(.01 * node_table[radius_feature].values, 0.003, 1),
+        fill_color=[_rgb2hex(tuple([int(np.round(i)) for i in _pseudocolor(val)])) if not np.isnan(val)
+                    else '#808080' for val in node_table[color_feature].values],
+        font_size=[f'{size:g}pt' for size in np.maximum(node_table['scaled_user_count'].fillna(0).values, 8)]
+    )
+
+    # user defined values
+    for k in features:
+        attributes[k] = np.round(node_table[k].values, 2).astype(str)
+
+    return attributes
+
+
 def _prepare_data(connections, stations, lines, data, radius_feature, color_feature, features):
     """
     Prepares data for plotting, creates objects necessary for bokeh.
@@ -54,62 +143,21 @@ def _prepare_data(connections, stations, lines, data, radius_feature, color_feat
 
     Returns:
     -------
-    source : ColumnDataSource with data
+    source : ColumnDataSource with data, rows are in the order of graph.nodes()
     TOOLTIPS : Tooltips for plot
     graph : networkx graph
     locations : dictionary of stations and normalized coordinates
     """
-    # create graph
-    stations['node_name'] = stations['name'] + '_' + stations['line'].astype(str)
-    connections['time'] = 1
-    graph = nx.Graph()
-
-    for connection_id, connection in connections.iterrows():
-        ind1 = connection['station1'] - 1
-        ind2 = connection['station2'] - 1
-        station1_name = stations.iloc[ind1]['node_name']
-        station2_name = stations.iloc[ind2]['node_name']
-        graph.add_edge(station1_name, station2_name, time=connection['time'])
-
-    normed = stations[['longitude', 'latitude']]
-    normed = normed - normed.min()
-    normed = normed / normed.max()
-    locations = dict(zip(stations['node_name'], normed[['longitude', 'latitude']].values))
-
-    x = []
-    y = []
-    name = []
-    radius = []
-    fill_color = []
-    line_l = []
-    d = {i: [] for i in features}
-
-    for node in graph.nodes():
-        # main values
-        x.append(locations[node][0])
-        y.append(locations[node][1])
-        name.append(node.split('_')[0])
-        radius.append(np.clip(.01 * data.loc[(data['display_name'] == node.split('_')[0]) & (
-                data['line'] == int(node.split('_')[1])), radius_feature].values[0], 0.003, 1))
-        colour = _pseudocolor(data.loc[(data['display_name'] == node.split('_')[0]) & (
-                data['line'] == int(node.split('_')[1])), color_feature].values[0])
-        fill_color.append(_rgb2hex(tuple([int(np.round(i)) for i in colour])))
-        line_l.append(lines.loc[lines.line == int(node.split('_')[1]), 'name'].values[0])
-
-        # user defined values
-        for k in d.keys():
-            d[k].append(str(np.round(data.loc[(data['display_name'] == node.split('_')[0]) & (
-                    data['line'] == int(node.split('_')[1])), 'total_traffic'].values[0], 2)))
+    graph, locations, nodes = _build_graph(connections, stations)
 
+    xy = np.array([locations[node] for node in nodes.index])
     source = ColumnDataSource(data=dict(
-        x=x,
-        y=y,
-        radius=radius,
-        fill_color=fill_color,
-        name=name,
-        line_l=line_l
+        x=xy[:, 0],
+        y=xy[:, 1],
+        name=nodes['name'].values,
+        line_l=lines.drop_duplicates('line').set_index('line')['name'].reindex(nodes['line'].values).values
     ))
-    for k, v in d.items():
+    for k, v in _node_attributes(nodes, data, radius_feature, color_feature, features).items():
         source.add(v, k)
 
     TOOLTIPS = []
@@ -119,6 +167,65 @@ def _prepare_data(connections, stations, lines, data, radius_feature, color_feat
     return source, TOOLTIPS, graph, locations
 
 
+def _edge_source(graph, locations, lines):
+    """
+    Creates one source with all graph edges for a single multi_line glyph.
+
+    Parameters:
+    -----------
+    graph : networkx graph
+    locations : dictionary of stations and normalized coordinates
+    lines : data from metro class
+
+    Returns:
+    -------
+    ColumnDataSource with edge coordinates and colors. Transfers are white.
+    """
+    line_colours = dict(zip(lines['line'], lines['colour']))
+
+    edges = list(graph.edges())
+    edge_lines = [(int(u.split('_')[1]), int(v.split('_')[1])) for u, v in edges]
+
+    return ColumnDataSource(data=dict(
+        xs=[[locations[u][0], locations[v][0]] for u, v in edges],
+        ys=[[locations[u][1], locations[v][1]] for u, v in edges],
+        line_color=[line_colours[a] if a == b else '#FFFFFF' for a, b in edge_lines]
+    ))
+
+
+def _draw(source, TOOLTIPS, graph, locations, lines):
+    """Creates bokeh figure with edges, stations and labels."""
+    p = figure(
+        x_range=(.4, .7),
+        y_range=(.2, .5),
+        height=700,
+        width=900, tooltips=TOOLTIPS
+    )
+    p.multi_line(
+        xs='xs',
+        ys='ys',
+        line_color='line_color',
+        line_width=5,
+        source=_edge_source(graph, locations, lines)
+    )
+
+    p.circle(
+        "x", "y", radius='radius',
+        fill_color='fill_color',
+        line_alpha=0, source=source)
+    p.text(
+        'x',
+        'y',
+        text='name',
+        text_font_size={'field': 'font_size'},
+        # text_alpha = pageranks[node],
+        text_align='center',
+        text_font_style='bold',
+        source=source)
+
+    return p
+
+
 def plot(connections, stations, lines, data, radius_feature, color_feature, features, output_file_name=None,
          return_plot=False):
     """
@@ -136,44 +243,7 @@ def plot(connections, stations, lines, data, radius_feature, color_feature, feat
     """
     source, TOOLTIPS, graph, locations = _prepare_data(connections, stations, lines, data, radius_feature,
                                                        color_feature, features)
-    p = figure(
-        x_range=(.4, .7),
-        y_range=(.2, .5),
-        height=700,
-        width=900, tooltips=TOOLTIPS
-    )
-    for edge in graph.edges():
-        a = edge[0].split('_')[1]
-        b = edge[1].split('_')[1]
-        if a != b:
-            line_color = '#FFFFFF'
-            name = 'Пересадка'
-        else:
-            line_color = lines.loc[lines['line'] == int(a), 'colour'].values[0]
-            name = lines.loc[lines['line'] == int(a), 'name'].values[0]
-
-        p.line(
-            x=[locations[pt][0] for pt in edge],
-            y=[locations[pt][1] for pt in edge],
-            line_color=line_color,
-            line_width=5,
-            name=name
-        )
-
-    p.circle(
-        "x", "y", radius='radius',
-        fill_color='fill_color',
-        line_alpha=0, source=source)
-    for node in graph.nodes():
-        p.text(
-            [locations[node][0]],
-            [locations[node][1]],
-            text={'value': node.split('_')[0]},
-            text_font_size=str(max(data.loc[(data['display_name'] == node.split('_')[0]) & (
-                        data['line'] == int(node.split('_')[1])), 'scaled_user_count'].values[0] * 1, 8)) + "pt",
-            # text_alpha = pageranks[node],
-            text_align='center',
-            text_font_style='bold')
+    p = _draw(source, TOOLTIPS, graph, locations, lines)
     if output_file_name:
         output_file(f"{output_file_name}.html")
         save(p)
@@ -182,6 +252,81 @@ def plot(connections, stations, lines, data, radius_feature, color_feature, feat
         return p
 
 
+def plot_months(connections, stations, lines, data, radius_feature, color_feature, features,
+                month_column='report_month', output_file_name=None, return_plot=False):
+    """
+    Plots metro data for several months in one figure with a slider.
+
+    Graph and layout are built once, data for all months is packed into one source
+    and months are switched in the browser.
+
+    Parameters:
+    -----------
+    connections, stations, lines - data from metro class
+    data : pd.DataFrame()
+        data prepared by metro class for several months
+    radius_feature, color_feature, features - see _prepare_data
+    month_column : str
+        column with month in data
+    output_file_name : str
+        name of html file to save plot
+    return_plot : bool
+        return figure with slider
+
+    Returns:
+    -------
+    bokeh layout with figure and slider if return_plot is True
+    """
+    graph, locations, nodes = _build_graph(connections, stations)
+    months = sorted(data[month_column].unique())
+
+    xy = np.array([locations[node] for node in nodes.index])
+    source = ColumnDataSource(data=dict(
+        x=xy[:, 0],
+        y=xy[:, 1],
+        name=nodes['name'].values,
+        line_l=lines.drop_duplicates('line').set_index('line')['name'].reindex(nodes['line'].values).values
+    ))
+
+    # month columns are stored as "<column>__<month number>", displayed columns are copied from them
+    columns = []
+    for i, month in enumerate(months):
+        attributes = _node_attributes(nodes, data.loc[data[month_column] == month], radius_feature,
+                                      color_feature, features)
+        for k, v in attributes.items():
+            source.add(v, f'{k}__{i}')
+        columns = list(attributes.keys())
+    for k in columns:
+        source.add(source.data[f'{k}__0'], k)
+
+    TOOLTIPS = []
+    for i in features:
+        TOOLTIPS.append((i, f'@{i}'))
+
+    p = _draw(source, TOOLTIPS, graph, locations, lines)
+
+    month_names = [str(month) for month in months]
+    slider = Slider(start=0, end=max(len(months) - 1, 1), value=0, step=1, title=month_names[0],
+                    disabled=len(months) < 2)
+    slider.js_on_change('value', CustomJS(args=dict(source=source, columns=columns, months=month_names), code="""
+        const i = cb_obj.value;
+        const data = source.data;
+        for (const column of columns) {
+            data[column] = data[column + '__' + i];
+        }
+        cb_obj.title = months[i];
+        source.change.emit();
+    """))
+    layout = column(p, slider)
+
+    if output_file_name:
+        output_file(f"{output_file_name}.html")
+        save(layout)
+
+    if return_plot:
+        return layout
+
+
 if __name__ == '__main__':
     # create class instance and get data from api
     from metro import MetroData
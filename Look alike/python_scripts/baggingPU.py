@@ -7,43 +7,87 @@
 # Adapted for PU learning by Roy Wright <roy.w.wright@gmail.com>
 # (work in progress)
 #
-# A better idea: instead of a separate PU class, modify the original
-# sklearn BaggingClassifier so that the parameters `max_samples` 
-# and `bootstrap` may be lists or dicts...
+# The parameters `max_samples` and `bootstrap` may be pairs for positives
+# and unlabeled,
 # e.g. for a PU problem with 500 positives and 10000 unlabeled, we might set
 # max_samples = [500, 500]     (to balance P and U in each bag)
-# bootstrap = [True, False]    (to only bootstrap the unlabeled)
+# bootstrap = [False, True]    (to only bootstrap the unlabeled)
 
 
 from __future__ import division
 
+import os
+import shutil
+import tempfile
 import itertools
 import numbers
 import numpy as np
+import pandas as pd
+from scipy.sparse import issparse, csr_matrix, hstack
 from warnings import warn
 from abc import ABCMeta, abstractmethod
 
-from sklearn.base import ClassifierMixin, RegressorMixin
-from sklearn.externals.joblib import Parallel, delayed
-from sklearn.externals.six import with_metaclass
-from sklearn.externals.six.moves import zip
-from sklearn.metrics import r2_score, accuracy_score
+from joblib import Parallel, delayed, dump, load, effective_n_jobs
+from sklearn.base import (BaseEstimator, ClassifierMixin, MetaEstimatorMixin,
+                          clone)
+from sklearn.metrics import accuracy_score
 from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
 from sklearn.utils import check_random_state, check_X_y, check_array, column_or_1d
 from sklearn.utils.random import sample_without_replacement
 from sklearn.utils.validation import has_fit_parameter, check_is_fitted
-from sklearn.utils import indices_to_mask, check_consistent_length
-from sklearn.utils.metaestimators import if_delegate_has_method
+from sklearn.utils import check_consistent_length
+from sklearn.utils.metaestimators import available_if
 from sklearn.utils.multiclass import check_classification_targets
 
-from sklearn.ensemble.base import BaseEnsemble, _partition_estimators
 
-
-__all__ = ["BaggingClassifierPU"]
+__all__ = ["BaggingClassifierPU", "FlatTreeEnsemble"]
 
 MAX_INT = np.iinfo(np.int32).max
 
 
+def _partition_estimators(n_estimators, n_jobs):
+    """Private function used to partition estimators between jobs."""
+    # Compute the number of jobs
+    n_jobs = min(effective_n_jobs(n_jobs), n_estimators)
+
+    # Partition estimators between jobs
+    n_estimators_per_job = np.full(n_jobs, n_estimators // n_jobs, dtype=int)
+    n_estimators_per_job[:n_estimators % n_jobs] += 1
+    starts = np.cumsum(n_estimators_per_job)
+
+    return n_jobs, n_estimators_per_job.tolist(), [0] + starts.tolist()
+
+
+def _set_random_states(estimator, random_state):
+    """Set all random_state parameters of an estimator from one seed."""
+    random_state = check_random_state(random_state)
+    to_set = {}
+    for key in sorted(estimator.get_params(deep=True)):
+        if key == "random_state" or key.endswith("__random_state"):
+            to_set[key] = random_state.randint(MAX_INT)
+
+    if to_set:
+        estimator.set_params(**to_set)
+
+
+def indices_to_mask(indices, mask_length):
+    """Boolean mask of length mask_length which is True at indices."""
+    mask = np.zeros(mask_length, dtype=bool)
+    mask[indices] = True
+
+    return mask
+
+
+def _estimator_has(attr):
+    """Check that the base estimator has attr, for available_if."""
+    def check(self):
+        if hasattr(self, "base_estimator_"):
+            return hasattr(self.base_estimator_, attr)
+        return hasattr(self.base_estimator or DecisionTreeClassifier(), attr)
+
+    return check
+
+
 def _generate_indices(random_state, bootstrap, n_population, n_samples):
     """Draw randomly sampled indices."""
     # Draw sample indices
@@ -63,23 +107,216 @@ def _generate_bagging_indices(random_state, bootstrap_features,
     # Get valid random state
     random_state = check_random_state(random_state)
 
-    # Draw indices
-    feature_indices = _generate_indices(random_state, bootstrap_features,
-                                        n_features, max_features)
+    # Draw indices, features are sorted so that all features are X itself
+    feature_indices = np.sort(_generate_indices(random_state, bootstrap_features,
+                                                n_features, max_features))
     sample_indices = _generate_indices(random_state, bootstrap_samples,
                                        n_samples, max_samples)
 
     return feature_indices, sample_indices
 
 
-def _parallel_build_estimators(n_estimators, ensemble, X, y, sample_weight,
+def _generate_pu_indices(random_state, bootstrap_features, bootstrap,
+                         n_features, iP, iU, max_features, max_samples):
+    """Randomly draw feature and sample indices of a PU bag.
+
+    bootstrap and max_samples are pairs for positives and unlabeled,
+    all positives are used if max_samples of positives is None."""
+    random_state = check_random_state(random_state)
+
+    # Unlabeled are drawn first, so that bags with all positives are the same
+    # as drawn by _generate_bagging_indices
+    features, unlabeled = _generate_bagging_indices(random_state,
+                                                    bootstrap_features,
+                                                    bootstrap[1], n_features,
+                                                    len(iU), max_features,
+                                                    max_samples[1])
+    if max_samples[0] is None:
+        positives = iP
+    else:
+        positives = iP[_generate_indices(random_state, bootstrap[0],
+                                         len(iP), max_samples[0])]
+
+    return features, np.concatenate([iU[unlabeled], positives])
+
+
+def _validate_pu_samples(max_samples, n_samples, name):
+    """Convert max_samples of one class into the number of samples."""
+    if not isinstance(max_samples, (numbers.Integral, np.integer)):
+        max_samples = int(max_samples * n_samples)
+
+    if not (0 < max_samples <= n_samples):
+        raise ValueError("max_samples must be positive"
+                         " and no larger than the number of %s points" % name)
+
+    return max_samples
+
+
+def _select(X, features, indices=None):
+    """Select samples and features of X with at most one copy.
+
+    No copy is made if all features and all samples are used."""
+    all_features = (len(features) == X.shape[1] and
+                    np.array_equal(features, np.arange(X.shape[1])))
+
+    if indices is None:
+        return X if all_features else X[:, features]
+
+    if all_features:
+        return X[indices]
+
+    if issparse(X):
+        return (X[indices])[:, features]
+
+    return X[np.ix_(indices, features)]
+
+
+def _share(X, n_jobs, dtype=None, temp_folder=None, backend=None):
+    """Dump dense X into a memory-mapped file once.
+
+    Jobs receive the file instead of a pickled copy of X and worker processes
+    read the same pages. Threads use X itself.
+    Returns X and the folder to remove after the jobs."""
+    if dtype is not None and X.dtype != dtype:
+        X = X.astype(dtype)
+
+    if (n_jobs == 1 or backend == "threading" or issparse(X) or
+            isinstance(X, np.memmap)):
+        return X, None
+
+    folder = tempfile.mkdtemp(prefix='baggingPU_', dir=temp_folder)
+    file_name = os.path.join(folder, 'X.pkl')
+    dump(X, file_name)
+
+    return load(file_name, mmap_mode='r'), folder
+
+
+def _row_blocks(X, chunk_size):
+    """Split X into blocks of at most chunk_size rows.
+
+    X is an array, memmap, sparse matrix or DataFrame, which is sliced
+    without a copy of the whole matrix, or an iterable of such blocks."""
+    if hasattr(X, 'shape') and len(X.shape) == 2:
+        for start in range(0, X.shape[0], chunk_size):
+            yield X[start:start + chunk_size]
+    else:
+        for block in X:
+            for sub_block in _row_blocks(block, chunk_size):
+                yield sub_block
+
+
+def iter_parquet(path, columns=None, batch_size=100000):
+    """Read feature columns of a parquet file as blocks of rows.
+
+    Can be passed to `BaggingClassifierPU.iter_predict_proba`."""
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size,
+                                                   columns=columns):
+        yield batch.to_pandas()
+
+
+def _encode_categories(X, categories=None, encoding="ordinal", columns=None):
+    """Encode categorical columns of a DataFrame without dense one-hot.
+
+    Columns with non numeric dtype are categorical. With "ordinal"
+    they are replaced by category codes (-1 for unknown and missing), which
+    trees split on directly. With "onehot" they are one-hot encoded into
+    a sparse CSR matrix next to the numeric columns.
+
+    categories maps columns to their categories, if None they are taken
+    from X. An empty dict means the model has no categorical columns, then
+    all columns of X must be numeric. columns are the fitted column names,
+    X must have the same columns in the same order. Returns encoded X and
+    categories, X is returned unchanged with an empty dict if it has no
+    categorical columns and with None if it is not a DataFrame."""
+    if not isinstance(X, pd.DataFrame):
+        if categories:
+            raise ValueError("The model was fitted on a DataFrame with "
+                             "categorical columns, X must be a DataFrame.")
+        return X, None
+
+    if columns is not None and list(X.columns) != list(columns):
+        raise ValueError("X must have the columns the model was fitted on "
+                         "in the same order: {0}".format(list(columns)))
+
+    if categories is None:
+        categories = {col: X[col].astype("category").cat.categories
+                      for col in X.columns
+                      if not pd.api.types.is_numeric_dtype(X[col])}
+        if not categories:
+            return X, categories
+    elif not categories:
+        non_numeric = [col for col in X.columns
+                       if not pd.api.types.is_numeric_dtype(X[col])]
+        if non_numeric:
+            raise ValueError("The model was fitted without categorical "
+                             "columns, X has non numeric columns "
+                             "{0}".format(non_numeric))
+        return X, categories
+
+    codes = {col: pd.Categorical(X[col], categories=values).codes
+             for col, values in categories.items()}
+
+    if encoding == "ordinal":
+        X = X.assign(**{col: code.astype(np.float32)
+                        for col, code in codes.items()})
+        return X.values.astype(np.float32), categories
+
+    if encoding != "onehot":
+        raise ValueError("categorical_encoding must be 'ordinal' or 'onehot'")
+
+    numeric = X.drop(columns=list(categories)).values.astype(np.float32)
+    blocks = [csr_matrix(numeric)]
+    for col, values in categories.items():
+        rows = np.flatnonzero(codes[col] >= 0)
+        blocks.append(csr_matrix((np.ones(len(rows), dtype=np.float32),
+                                  (rows, codes[col][rows])),
+                                 shape=(len(X), len(values))))
+
+    return hstack(blocks, format="csr"), categories
+
+
+def _pu_indices(y):
+    """Indices of positive and unlabeled samples."""
+    y = np.asarray(y)
+    return np.flatnonzero(y == 1), np.flatnonzero(y < 1)
+
+
+def _compact_indices(indices, n_population):
+    """Unique sorted indices in the smallest unsigned integer type."""
+    dtype = np.uint32 if n_population <= np.iinfo(np.uint32).max else np.uint64
+    return np.unique(indices).astype(dtype)
+
+
+def _accumulate_oob(predictions, estimator, X, features, oob_indices):
+    """Add predictions of an estimator for its out of bag samples."""
+    if len(oob_indices) == 0:
+        return
+
+    X_oob = _select(X, features, oob_indices)
+
+    if hasattr(estimator, "predict_proba"):
+        predictions[oob_indices, :] += estimator.predict_proba(X_oob)
+
+    else:
+        # Resort to voting
+        np.add.at(predictions, (oob_indices, estimator.predict(X_oob)), 1)
+
+
+def _parallel_build_estimators(n_estimators, ensemble, X, y, iP, iU, sample_weight,
                                seeds, total_n_estimators, verbose):
-    """Private function used to build a batch of estimators within a job."""
+    """Private function used to build a batch of estimators within a job.
+
+    If ensemble.oob_score is set, out of bag predictions of the batch
+    are accumulated into its own array, otherwise None is returned.
+    If ensemble.store_samples is set, sorted indices of in-bag samples
+    are returned for every estimator, otherwise None."""
     # Retrieve settings
     n_samples, n_features = X.shape
     max_features = ensemble._max_features
     max_samples = ensemble._max_samples
-    bootstrap = ensemble.bootstrap
+    bootstrap = ensemble._bootstrap
     bootstrap_features = ensemble.bootstrap_features
     support_sample_weight = has_fit_parameter(ensemble.base_estimator_,
                                               "sample_weight")
@@ -89,25 +326,29 @@ def _parallel_build_estimators(n_estimators, ensemble, X, y, sample_weight,
     # Build estimators
     estimators = []
     estimators_features = []
+    oob_predictions = (np.zeros((n_samples, ensemble.n_classes_))
+                       if ensemble.oob_score else None)
+    samples = [] if ensemble.store_samples else None
 
     for i in range(n_estimators):
         if verbose > 1:
             print("Building estimator %d of %d for this parallel run "
                   "(total %d)..." % (i + 1, n_estimators, total_n_estimators))
 
-        random_state = np.random.RandomState(seeds[i])
+        # Estimator and bagging indices are seeded separately, so that
+        # _get_estimators_indices() draws the same indices as here
+        random_state = seeds[i]
         estimator = ensemble._make_estimator(append=False,
                                              random_state=random_state)
 
         ################ MAIN MODIFICATION FOR PU LEARNING ##################
-        iP = [pair[0] for pair in enumerate(y) if pair[1] == 1]
-        iU = [pair[0] for pair in enumerate(y) if pair[1] < 1]            
-        features, indices = _generate_bagging_indices(random_state,
-                                                      bootstrap_features,
-                                                      bootstrap, n_features,
-                                                      len(iU), max_features,
-                                                      max_samples)
-        indices = [iU[i] for i in indices] + iP
+        features, indices = _generate_pu_indices(random_state,
+                                                 bootstrap_features,
+                                                 bootstrap, n_features,
+                                                 iP, iU, max_features,
+                                                 max_samples)
+        if samples is not None:
+            samples.append(_compact_indices(indices, n_samples))
         #####################################################################
         
         
@@ -118,23 +359,27 @@ def _parallel_build_estimators(n_estimators, ensemble, X, y, sample_weight,
             else:
                 curr_sample_weight = sample_weight.copy()
 
-            if bootstrap:
+            if any(bootstrap):
                 sample_counts = np.bincount(indices, minlength=n_samples)
                 curr_sample_weight *= sample_counts
             else:
                 not_indices_mask = ~indices_to_mask(indices, n_samples)
                 curr_sample_weight[not_indices_mask] = 0
 
-            estimator.fit(X[:, features], y, sample_weight=curr_sample_weight)
+            estimator.fit(_select(X, features), y, sample_weight=curr_sample_weight)
 
         # Draw samples, using a mask, and then fit
         else:
-            estimator.fit((X[indices])[:, features], y[indices])
+            estimator.fit(_select(X, features, indices), y[indices])
 
         estimators.append(estimator)
         estimators_features.append(features)
 
-    return estimators, estimators_features
+        if oob_predictions is not None:
+            oob_indices = np.flatnonzero(~indices_to_mask(indices, n_samples))
+            _accumulate_oob(oob_predictions, estimator, X, features, oob_indices)
+
+    return estimators, estimators_features, oob_predictions, samples
 
 
 def _parallel_predict_proba(estimators, estimators_features, X, n_classes):
@@ -144,7 +389,7 @@ def _parallel_predict_proba(estimators, estimators_features, X, n_classes):
 
     for estimator, features in zip(estimators, estimators_features):
         if hasattr(estimator, "predict_proba"):
-            proba_estimator = estimator.predict_proba(X[:, features])
+            proba_estimator = estimator.predict_proba(_select(X, features))
 
             if n_classes == len(estimator.classes_):
                 proba += proba_estimator
@@ -155,7 +400,7 @@ def _parallel_predict_proba(estimators, estimators_features, X, n_classes):
 
         else:
             # Resort to voting
-            predictions = estimator.predict(X[:, features])
+            predictions = estimator.predict(_select(X, features))
 
             for i in range(n_samples):
                 proba[i, predictions[i]] += 1
@@ -168,10 +413,10 @@ def _parallel_predict_log_proba(estimators, estimators_features, X, n_classes):
     n_samples = X.shape[0]
     log_proba = np.empty((n_samples, n_classes))
     log_proba.fill(-np.inf)
-    all_classes = np.arange(n_classes, dtype=np.int)
+    all_classes = np.arange(n_classes, dtype=int)
 
     for estimator, features in zip(estimators, estimators_features):
-        log_proba_estimator = estimator.predict_log_proba(X[:, features])
+        log_proba_estimator = estimator.predict_log_proba(_select(X, features))
 
         if n_classes == len(estimator.classes_):
             log_proba = np.logaddexp(log_proba, log_proba_estimator)
@@ -190,12 +435,12 @@ def _parallel_predict_log_proba(estimators, estimators_features, X, n_classes):
 
 def _parallel_decision_function(estimators, estimators_features, X):
     """Private function used to compute decisions within a job."""
-    return sum(estimator.decision_function(X[:, features])
+    return sum(estimator.decision_function(_select(X, features))
                for estimator, features in zip(estimators,
                                               estimators_features))
 
 
-class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
+class BaseBaggingPU(MetaEstimatorMixin, BaseEstimator, metaclass=ABCMeta):
     """Base class for Bagging PU meta-estimator.
 
     Warning: This class should not be used directly. Use derived classes
@@ -214,11 +459,13 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
                  warm_start=False,
                  n_jobs=1,
                  random_state=None,
-                 verbose=0):
-        super(BaseBaggingPU, self).__init__(
-            base_estimator=base_estimator,
-            n_estimators=n_estimators)
-
+                 verbose=0,
+                 temp_folder=None,
+                 store_samples=False,
+                 backend=None,
+                 categorical_encoding="ordinal"):
+        self.base_estimator = base_estimator
+        self.n_estimators = n_estimators
         self.max_samples = max_samples
         self.max_features = max_features
         self.bootstrap = bootstrap
@@ -228,6 +475,47 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
         self.n_jobs = n_jobs
         self.random_state = random_state
         self.verbose = verbose
+        self.temp_folder = temp_folder
+        self.store_samples = store_samples
+        self.backend = backend
+        self.categorical_encoding = categorical_encoding
+
+    def __len__(self):
+        """Return the number of estimators in the ensemble."""
+        return len(self.estimators_)
+
+    def _validate_estimator(self, default=None):
+        """Check the estimator and set the base_estimator_ attribute."""
+        if self.base_estimator is not None:
+            self.base_estimator_ = self.base_estimator
+        else:
+            self.base_estimator_ = default
+
+    def _make_estimator(self, append=True, random_state=None):
+        """Make and configure a copy of the `base_estimator_` attribute."""
+        estimator = clone(self.base_estimator_)
+
+        if random_state is not None:
+            _set_random_states(estimator, random_state)
+
+        if append:
+            self.estimators_.append(estimator)
+
+        return estimator
+
+    def _backend(self):
+        """joblib backend of parallel jobs.
+
+        Decision trees release the GIL, so threads share X without a copy,
+        other estimators use joblib default (processes)."""
+        if self.backend is not None:
+            return self.backend
+
+        if isinstance(getattr(self, "base_estimator_", None),
+                      (DecisionTreeClassifier, DecisionTreeRegressor)):
+            return "threading"
+
+        return None
 
     def fit(self, X, y, sample_weight=None):
         """Build a Bagging ensemble of estimators from the training
@@ -289,6 +577,10 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
         self.y = y
         
         # Convert data
+        self.feature_names_in_ = (list(X.columns)
+                                  if isinstance(X, pd.DataFrame) else None)
+        X, self.categories_ = _encode_categories(X, None,
+                                                 self.categorical_encoding)
         X, y = check_X_y(X, y, ['csr', 'csc'])
         if sample_weight is not None:
             sample_weight = check_array(sample_weight, ensure_2d=False)
@@ -305,19 +597,43 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
         if max_depth is not None:
             self.base_estimator_.max_depth = max_depth
 
-        # Validate max_samples
+        if issparse(X):
+            # Converted once here and not by every estimator
+            X = X.asformat(self._sparse_format())
+            X.sort_indices()
+
+        # Positive and unlabeled indices are shared by all estimators
+        iP, iU = _pu_indices(y)
+
+        # Validate max_samples, a number for unlabeled or a pair for
+        # positives and unlabeled
         if max_samples is None:
             max_samples = self.max_samples
-        elif not isinstance(max_samples, (numbers.Integral, np.integer)):
-            max_samples = int(max_samples * sum(y < 1))
 
-        if not (0 < max_samples <= sum(y < 1)):
-            raise ValueError("max_samples must be positive"
-                             " and no larger than the number of unlabeled points")
+        if isinstance(max_samples, (list, tuple)):
+            if len(max_samples) != 2:
+                raise ValueError("max_samples must be a number or a pair "
+                                 "for positives and unlabeled")
+            max_samples = (
+                _validate_pu_samples(max_samples[0], len(iP), "positive"),
+                _validate_pu_samples(max_samples[1], len(iU), "unlabeled"))
+        else:
+            # All positives in every bag
+            max_samples = (None, _validate_pu_samples(max_samples, len(iU),
+                                                      "unlabeled"))
 
-        # Store validated integer row sampling value
+        # Store validated integer row sampling values
         self._max_samples = max_samples
 
+        # Validate bootstrap
+        if isinstance(self.bootstrap, (list, tuple)):
+            if len(self.bootstrap) != 2:
+                raise ValueError("bootstrap must be a boolean or a pair "
+                                 "for positives and unlabeled")
+            self._bootstrap = tuple(bool(b) for b in self.bootstrap)
+        else:
+            self._bootstrap = (bool(self.bootstrap), bool(self.bootstrap))
+
         # Validate max_features
         if isinstance(self.max_features, (numbers.Integral, np.integer)):
             max_features = self.max_features
@@ -331,7 +647,7 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
         self._max_features = max_features
 
         # Other checks
-        if not self.bootstrap and self.oob_score:
+        if not any(self._bootstrap) and self.oob_score:
             raise ValueError("Out of bag estimation only available"
                              " if bootstrap=True")
 
@@ -346,6 +662,7 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
             # Free allocated memory, if any
             self.estimators_ = []
             self.estimators_features_ = []
+            self._samples = [] if self.store_samples else None
 
         n_more_estimators = self.n_estimators - len(self.estimators_)
 
@@ -372,32 +689,88 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
         seeds = random_state.randint(MAX_INT, size=n_more_estimators)
         self._seeds = seeds
 
-        all_results = Parallel(n_jobs=n_jobs, verbose=self.verbose)(
+        # Trees work with float32, so X is converted once and not by every estimator
+        X_shared, folder = _share(X, n_jobs, self._fit_dtype(), self.temp_folder,
+                                  self._backend())
+
+        all_results = Parallel(n_jobs=n_jobs, verbose=self.verbose,
+                               backend=self._backend())(
             delayed(_parallel_build_estimators)(
                 n_estimators[i],
                 self,
-                X,
+                X_shared,
                 y,
+                iP,
+                iU,
                 sample_weight,
                 seeds[starts[i]:starts[i + 1]],
                 total_n_estimators,
                 verbose=self.verbose)
             for i in range(n_jobs))
 
+        if folder is not None:
+            del X_shared
+            shutil.rmtree(folder, ignore_errors=True)
+
         # Reduce
         self.estimators_ += list(itertools.chain.from_iterable(
             t[0] for t in all_results))
         self.estimators_features_ += list(itertools.chain.from_iterable(
             t[1] for t in all_results))
+        if self.store_samples and getattr(self, '_samples', None) is not None:
+            self._samples += list(itertools.chain.from_iterable(
+                t[3] for t in all_results))
+        else:
+            # Estimators from previous fits weren't stored
+            self._samples = None
 
         if self.oob_score:
-            self._set_oob_score(X, y)
+            self._set_oob_score(X, y, sum(t[2] for t in all_results))
 
         return self
 
+    def _sparse_format(self):
+        """Format of sparse X for fitting.
+
+        Trees are fitted on CSC, which is also cheap to slice by columns.
+        Other estimators get CSR, which is cheap to slice by rows."""
+        if isinstance(self.base_estimator_, (DecisionTreeClassifier,
+                                             DecisionTreeRegressor)):
+            return "csc"
+        return "csr"
+
+    def _check_X(self, X):
+        """Encode categorical columns and check X for prediction.
+
+        Sparse X is converted to CSR, which trees use for prediction."""
+        X, _ = _encode_categories(X, getattr(self, "categories_", None) or {},
+                                  self.categorical_encoding,
+                                  getattr(self, "feature_names_in_", None))
+        X = check_array(X, accept_sparse=['csr', 'csc'])
+        if issparse(X):
+            X = X.tocsr()
+
+        if self.n_features_ != X.shape[1]:
+            raise ValueError("Number of features of the model must "
+                             "match the input. Model n_features is {0} and "
+                             "input n_features is {1}."
+                             "".format(self.n_features_, X.shape[1]))
+
+        return X
+
+    def _fit_dtype(self):
+        """dtype to which X is converted before fitting, None to keep it."""
+        if isinstance(self.base_estimator_, (DecisionTreeClassifier,
+                                             DecisionTreeRegressor)):
+            return np.float32
+        return None
+
     @abstractmethod
-    def _set_oob_score(self, X, y):
-        """Calculate out of bag predictions and score."""
+    def _set_oob_score(self, X, y, predictions=None):
+        """Calculate out of bag predictions and score.
+
+        predictions are out of bag predictions accumulated by the build jobs,
+        if None they are calculated from estimators_samples_."""
 
     def _validate_y(self, y):
         # Default implementation
@@ -405,21 +778,23 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
 
     def _get_estimators_indices(self):
         # Get drawn indices along both sample and feature axes
+        if getattr(self, '_samples', None) is not None:
+            # Stored in-bag samples, no re-sampling
+            for features, sample_indices in zip(self.estimators_features_,
+                                                self._samples):
+                yield features, sample_indices
+            return
+
+        iP, iU = _pu_indices(self.y)
+
         for seed in self._seeds:
             # Operations accessing random_state must be performed identically
             # to those in `_parallel_build_estimators()`
-            random_state = np.random.RandomState(seed)
-            
             ############ MAIN MODIFICATION FOR PU LEARNING ###############
-            iP = [pair[0] for pair in enumerate(self.y) if pair[1] == 1]
-            iU = [pair[0] for pair in enumerate(self.y) if pair[1] < 1] 
-            
-            feature_indices, sample_indices = _generate_bagging_indices(
-                random_state, self.bootstrap_features, self.bootstrap,
-                self.n_features_, len(iU), self._max_features,
+            feature_indices, sample_indices = _generate_pu_indices(
+                seed, self.bootstrap_features, self._bootstrap,
+                self.n_features_, iP, iU, self._max_features,
                 self._max_samples)
-
-            sample_indices = [iU[i] for i in sample_indices] + iP
             ###############################################################
             
             yield feature_indices, sample_indices
@@ -443,8 +818,20 @@ class BaseBaggingPU(with_metaclass(ABCMeta, BaseEnsemble)):
 
         return sample_masks
 
+    @property
+    def estimators_sample_indices_(self):
+        """Indices of in-bag samples for each base estimator.
+
+        With store_samples=True indices are read from the compact store
+        in O(bag size), otherwise they are drawn again as in
+        `estimators_samples_`. Duplicates of bootstrap are not repeated
+        for the stored indices.
+        """
+        return [sample_indices for _, sample_indices
+                in self._get_estimators_indices()]
 
-class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
+
+class BaggingClassifierPU(ClassifierMixin, BaseBaggingPU):
     """A Bagging PU classifier.
 
     Adapted from sklearn.ensemble.BaggingClassifier, based on
@@ -461,8 +848,13 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
     n_estimators : int, optional (default=10)
         The number of base estimators in the ensemble.
 
-    max_samples : int or float, optional (default=1.0)
-        The number of unlabeled samples to draw to train each base estimator.
+    max_samples : int, float or pair of them, optional (default=1.0)
+        The number of unlabeled samples to draw to train each base estimator,
+        all positives are used. If a pair, the numbers of positive and
+        unlabeled samples, e.g. [500, 500] for small balanced bags.
+
+        - If int, then draw `max_samples` samples.
+        - If float, then draw `max_samples` share of the class samples.
 
     max_features : int or float, optional (default=1.0)
         The number of features to draw from X to train each base estimator.
@@ -470,8 +862,9 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
         - If int, then draw `max_features` features.
         - If float, then draw `max_features * X.shape[1]` features.
 
-    bootstrap : boolean, optional (default=True)
-        Whether samples are drawn with replacement.
+    bootstrap : boolean or pair of booleans, optional (default=True)
+        Whether samples are drawn with replacement. If a pair, separately
+        for positives and unlabeled, e.g. [False, True].
 
     bootstrap_features : boolean, optional (default=False)
         Whether features are drawn with replacement.
@@ -498,6 +891,27 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
     verbose : int, optional (default=0)
         Controls the verbosity of the building process.
 
+    temp_folder : str or None, optional (default=None)
+        Folder for the memory-mapped copy of X used by parallel jobs.
+        If None, the system temporary folder is used.
+
+    store_samples : bool, optional (default=False)
+        Whether to store in-bag samples of every estimator as sorted
+        indices (uint32 if possible), so that `estimators_samples_`
+        and OOB scoring don't draw them again.
+
+    backend : str or None, optional (default=None)
+        joblib backend of parallel jobs, e.g. "threading" or "loky".
+        If None, "threading" is used for decision trees, which release
+        the GIL and share X without a copy, and joblib default (processes)
+        for other base estimators.
+
+    categorical_encoding : str, optional (default="ordinal")
+        Encoding of categorical (category, string) columns of
+        a DataFrame X. "ordinal" replaces them with category codes, trees
+        split on them directly; "onehot" encodes them into a sparse matrix,
+        no dense one-hot columns are created.
+
     Attributes
     ----------
     base_estimator_ : estimator
@@ -510,6 +924,9 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
         The subset of drawn samples (i.e., the in-bag samples) for each base
         estimator. Each subset is defined by a boolean mask.
 
+    estimators_sample_indices_ : list of arrays
+        The indices of drawn samples for each base estimator.
+
     estimators_features_ : list of arrays
         The subset of drawn features for each base estimator.
 
@@ -528,6 +945,15 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
         are left out during the bootstrap. In these cases,
         `oob_decision_function_` contains NaN.
 
+    categories_ : dict or None
+        Categories of categorical columns of a DataFrame X, used to encode
+        X for prediction. Empty if X had no categorical columns, None if X
+        was not a DataFrame.
+
+    feature_names_in_ : list or None
+        Columns of a DataFrame X, a DataFrame X for prediction must have
+        the same columns in the same order. None if X was not a DataFrame.
+
     """
     def __init__(self,
                  base_estimator=None,
@@ -540,7 +966,11 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
                  warm_start=False,
                  n_jobs=1,
                  random_state=None,
-                 verbose=0):
+                 verbose=0,
+                 temp_folder=None,
+                 store_samples=False,
+                 backend=None,
+                 categorical_encoding="ordinal"):
 
         super(BaggingClassifierPU, self).__init__(
             base_estimator,
@@ -553,40 +983,27 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
             warm_start=warm_start,
             n_jobs=n_jobs,
             random_state=random_state,
-            verbose=verbose)
+            verbose=verbose,
+            temp_folder=temp_folder,
+            store_samples=store_samples,
+            backend=backend,
+            categorical_encoding=categorical_encoding)
 
     def _validate_estimator(self):
         """Check the estimator and set the base_estimator_ attribute."""
         super(BaggingClassifierPU, self)._validate_estimator(
             default=DecisionTreeClassifier())
 
-    def _set_oob_score(self, X, y):
-        n_samples = y.shape[0]
-        n_classes_ = self.n_classes_
-        classes_ = self.classes_
-
-        predictions = np.zeros((n_samples, n_classes_))
+    def _set_oob_score(self, X, y, predictions=None):
+        if predictions is None:
+            predictions = np.zeros((y.shape[0], self.n_classes_))
 
-        for estimator, samples, features in zip(self.estimators_,
-                                                self.estimators_samples_,
-                                                self.estimators_features_):
-            # Create mask for OOB samples
-            mask = ~samples
+            for estimator, samples, features in zip(self.estimators_,
+                                                    self.estimators_samples_,
+                                                    self.estimators_features_):
+                _accumulate_oob(predictions, estimator, X, features,
+                                np.flatnonzero(~samples))
 
-            if hasattr(estimator, "predict_proba"):
-                predictions[mask, :] += estimator.predict_proba(
-                    (X[mask, :])[:, features])
-
-            else:
-                p = estimator.predict((X[mask, :])[:, features])
-                j = 0
-
-                for i in range(n_samples):
-                    if mask[i]:
-                        predictions[i, p[j]] += 1
-                        j += 1
-
-                        
         # Modified: no warnings about non-OOB points (i.e. positives)
         with np.errstate(invalid='ignore'):  
             oob_decision_function = (predictions /
@@ -650,19 +1067,16 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
         """
         check_is_fitted(self, "classes_")
         # Check data
-        X = check_array(X, accept_sparse=['csr', 'csc'])
-
-        if self.n_features_ != X.shape[1]:
-            raise ValueError("Number of features of the model must "
-                             "match the input. Model n_features is {0} and "
-                             "input n_features is {1}."
-                             "".format(self.n_features_, X.shape[1]))
+        X = self._check_X(X)
 
         # Parallel loop
         n_jobs, n_estimators, starts = _partition_estimators(self.n_estimators,
                                                              self.n_jobs)
+        X, folder = _share(X, n_jobs, self._fit_dtype(), self.temp_folder,
+                           self._backend())
 
-        all_proba = Parallel(n_jobs=n_jobs, verbose=self.verbose)(
+        all_proba = Parallel(n_jobs=n_jobs, verbose=self.verbose,
+                             backend=self._backend())(
             delayed(_parallel_predict_proba)(
                 self.estimators_[starts[i]:starts[i + 1]],
                 self.estimators_features_[starts[i]:starts[i + 1]],
@@ -670,11 +1084,106 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
                 self.n_classes_)
             for i in range(n_jobs))
 
+        if folder is not None:
+            del X
+            shutil.rmtree(folder, ignore_errors=True)
+
         # Reduce
         proba = sum(all_proba) / self.n_estimators
 
         return proba
 
+    def iter_predict_proba(self, X, chunk_size=100000):
+        """Predict class probabilities for X block by block.
+
+        Only one block of rows is converted and sent to the jobs at a time,
+        so memory doesn't depend on the number of rows in X. Blocks are
+        converted to the dtype of the base estimator once and shared by all
+        estimators, with max_features=1.0 estimators get the block itself.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix, memmap} of shape = [n_samples, n_features]
+            or iterable of such blocks, e.g. `iter_parquet(path, features)`.
+
+        chunk_size : int, optional (default=100000)
+            The maximum number of rows in a block.
+
+        Yields
+        ------
+        p : array of shape = [n_block_samples, n_classes]
+            The class probabilities of the rows of the block.
+        """
+        check_is_fitted(self, "classes_")
+
+        n_jobs, n_estimators, starts = _partition_estimators(self.n_estimators,
+                                                             self.n_jobs)
+        dtype = self._fit_dtype()
+
+        with Parallel(n_jobs=n_jobs, verbose=self.verbose,
+                      backend=self._backend()) as parallel:
+            for block in _row_blocks(X, chunk_size):
+                block = self._check_X(block)
+                if dtype is not None and block.dtype != dtype:
+                    block = block.astype(dtype)
+
+                all_proba = parallel(
+                    delayed(_parallel_predict_proba)(
+                        self.estimators_[starts[i]:starts[i + 1]],
+                        self.estimators_features_[starts[i]:starts[i + 1]],
+                        block,
+                        self.n_classes_)
+                    for i in range(n_jobs))
+
+                yield sum(all_proba) / self.n_estimators
+
+    def predict_proba_chunked(self, X, chunk_size=100000, out=None):
+        """Predict class probabilities for X with bounded memory.
+
+        Parameters
+        ----------
+        X : {array-like, sparse matrix, memmap} of shape = [n_samples, n_features]
+            or iterable of such blocks, see `iter_predict_proba`.
+
+        chunk_size : int, optional (default=100000)
+            The maximum number of rows in a block.
+
+        out : array, str or None, optional (default=None)
+            Array of shape = [n_samples, n_classes] to write probabilities
+            into, e.g. a memmap. If str, probabilities are written into
+            a new .npy file with this name, which needs X with known shape.
+            If None, probabilities are returned as one array.
+
+        Returns
+        -------
+        p : array of shape = [n_samples, n_classes]
+            The class probabilities, out if it is given.
+        """
+        if isinstance(out, str):
+            if not hasattr(X, 'shape'):
+                raise ValueError("Number of rows of X must be known to create "
+                                 "the output file, pass an array as out.")
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64,
+                                            shape=(X.shape[0], self.n_classes_))
+
+        blocks = []
+        start = 0
+        for proba in self.iter_predict_proba(X, chunk_size):
+            if out is None:
+                blocks.append(proba)
+            else:
+                out[start:start + len(proba)] = proba
+            start += len(proba)
+
+        if out is None:
+            return (np.vstack(blocks) if blocks
+                    else np.empty((0, self.n_classes_)))
+
+        if hasattr(out, 'flush'):
+            out.flush()
+
+        return out
+
     def predict_log_proba(self, X):
         """Predict class log-probabilities for X.
 
@@ -697,19 +1206,14 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
         check_is_fitted(self, "classes_")
         if hasattr(self.base_estimator_, "predict_log_proba"):
             # Check data
-            X = check_array(X, accept_sparse=['csr', 'csc'])
-
-            if self.n_features_ != X.shape[1]:
-                raise ValueError("Number of features of the model must "
-                                 "match the input. Model n_features is {0} "
-                                 "and input n_features is {1} "
-                                 "".format(self.n_features_, X.shape[1]))
+            X = self._check_X(X)
 
             # Parallel loop
             n_jobs, n_estimators, starts = _partition_estimators(
                 self.n_estimators, self.n_jobs)
 
-            all_log_proba = Parallel(n_jobs=n_jobs, verbose=self.verbose)(
+            all_log_proba = Parallel(n_jobs=n_jobs, verbose=self.verbose,
+                                     backend=self._backend())(
                 delayed(_parallel_predict_log_proba)(
                     self.estimators_[starts[i]:starts[i + 1]],
                     self.estimators_features_[starts[i]:starts[i + 1]],
@@ -730,7 +1234,7 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
         else:
             return np.log(self.predict_proba(X))
 
-    @if_delegate_has_method(delegate='base_estimator')
+    @available_if(_estimator_has("decision_function"))
     def decision_function(self, X):
         """Average of the decision functions of the base classifiers.
 
@@ -752,19 +1256,14 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
         check_is_fitted(self, "classes_")
 
         # Check data
-        X = check_array(X, accept_sparse=['csr', 'csc'])
-
-        if self.n_features_ != X.shape[1]:
-            raise ValueError("Number of features of the model must "
-                             "match the input. Model n_features is {0} and "
-                             "input n_features is {1} "
-                             "".format(self.n_features_, X.shape[1]))
+        X = self._check_X(X)
 
         # Parallel loop
         n_jobs, n_estimators, starts = _partition_estimators(self.n_estimators,
                                                              self.n_jobs)
 
-        all_decisions = Parallel(n_jobs=n_jobs, verbose=self.verbose)(
+        all_decisions = Parallel(n_jobs=n_jobs, verbose=self.verbose,
+                                 backend=self._backend())(
             delayed(_parallel_decision_function)(
                 self.estimators_[starts[i]:starts[i + 1]],
                 self.estimators_features_[starts[i]:starts[i + 1]],
@@ -776,3 +1275,257 @@ class BaggingClassifierPU(BaseBaggingPU, ClassifierMixin):
 
         return decisions
 
+
+    def compile(self, engine="numpy", n_jobs=None):
+        """Compile fitted decision trees into one flat tree ensemble.
+
+        Parameters
+        ----------
+        engine : str, optional (default="numpy")
+            "numpy" for vectorized NumPy inference or "c" for a small C
+            kernel built with the system compiler, see `FlatTreeEnsemble`.
+
+        n_jobs : int or None, optional (default=None)
+            The number of threads of the "c" engine, self.n_jobs if None.
+
+        Returns
+        -------
+        flat : FlatTreeEnsemble
+            Predicts the same probabilities as `predict_proba`.
+        """
+        check_is_fitted(self, "classes_")
+        if self.categories_ and self.categorical_encoding != "ordinal":
+            raise ValueError("Only ordinal encoded categorical features "
+                             "can be compiled")
+
+        return FlatTreeEnsemble(self.estimators_, self.estimators_features_,
+                                self.n_classes_, self.n_features_, engine,
+                                self.n_jobs if n_jobs is None else n_jobs,
+                                categories=self.categories_,
+                                columns=self.feature_names_in_)
+
+
+_FLAT_TREES_SOURCE = r"""
+typedef struct {
+    double threshold;
+    int feature;
+    int left;
+    int right;
+    int pad;
+} node_t;
+
+/* Trees are the outer loop, so nodes of one tree stay in cache */
+void predict(const float *X, long n_samples, long n_features,
+             const node_t *nodes, const int *roots, long n_trees,
+             const double *value, long n_classes, double *out)
+{
+    for (long t = 0; t < n_trees; t++) {
+        for (long i = 0; i < n_samples; i++) {
+            const float *x = X + i * n_features;
+            const node_t *node = nodes + roots[t];
+            while (node->feature >= 0)
+                node = nodes + (x[node->feature] <= node->threshold ? node->left : node->right);
+            const double *v = value + (node - nodes) * n_classes;
+            double *o = out + i * n_classes;
+            for (long c = 0; c < n_classes; c++)
+                o[c] += v[c];
+        }
+    }
+}
+"""
+
+
+# Node record of the C kernel
+_NODE_DTYPE = np.dtype([("threshold", np.float64), ("feature", np.int32),
+                        ("left", np.int32), ("right", np.int32),
+                        ("pad", np.int32)])
+
+
+def _build_flat_trees_library(temp_folder=None):
+    """Compile the C kernel once and load it with ctypes."""
+    import ctypes
+    import hashlib
+    import subprocess
+
+    compiler = os.environ.get("CC", "cc")
+    digest = hashlib.md5((compiler + _FLAT_TREES_SOURCE).encode("utf-8"))
+    folder = os.path.join(temp_folder or tempfile.gettempdir(),
+                          "baggingPU_flat_" + digest.hexdigest()[:16])
+    library = os.path.join(folder, "flat_trees.so")
+
+    if not os.path.exists(library):
+        os.makedirs(folder, exist_ok=True)
+        source = os.path.join(folder, "flat_trees.c")
+        with open(source, "w") as f:
+            f.write(_FLAT_TREES_SOURCE)
+        # Build into a unique file, so parallel builds don't see a partial one
+        tmp_library = library + ".%d" % os.getpid()
+        subprocess.check_call([compiler, "-O3", "-shared", "-fPIC",
+                               source, "-o", tmp_library])
+        os.replace(tmp_library, library)
+
+    lib = ctypes.CDLL(library)
+    c_long = ctypes.c_long
+
+    def pointer(dtype):
+        return np.ctypeslib.ndpointer(dtype=dtype, flags="C_CONTIGUOUS")
+
+    lib.predict.restype = None
+    lib.predict.argtypes = [pointer(np.float32), c_long, c_long,
+                            pointer(_NODE_DTYPE), pointer(np.int32), c_long,
+                            pointer(np.float64), c_long, pointer(np.float64)]
+
+    return lib
+
+
+class FlatTreeEnsemble(object):
+    """Decision trees of a bagging ensemble compiled into flat node arrays.
+
+    Nodes of all trees are concatenated, features are remapped through
+    `estimators_features_` to columns of X and leaves store normalized class
+    probabilities, so all trees are evaluated at once without calling every
+    estimator. Leaves point to themselves and have feature -1.
+
+    Engines
+    -------
+    numpy : rows and trees are moved down by vectorized NumPy steps, only
+        pairs which haven't reached a leaf are processed at every depth.
+    c : one loop over rows and trees compiled with the system compiler
+        ($CC or cc) and called with ctypes. Blocks of rows are processed by
+        n_jobs threads, ctypes releases the GIL.
+
+    Example
+    -------
+    >>> flat = BaggingClassifierPU(n_estimators=100).fit(X, y).compile("c")
+    >>> proba = flat.predict_proba(X)
+    """
+    def __init__(self, estimators, estimators_features, n_classes, n_features,
+                 engine="numpy", n_jobs=1, chunk_size=10000, categories=None,
+                 columns=None):
+        if engine not in ("numpy", "c"):
+            raise ValueError("engine must be 'numpy' or 'c'")
+
+        self.n_classes = n_classes
+        self.n_features = n_features
+        self.n_trees = len(estimators)
+        self.engine = engine
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.categories = categories
+        self.columns = columns
+
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset = 0
+
+        for estimator, estimator_features in zip(estimators, estimators_features):
+            tree = getattr(estimator, "tree_", None)
+            if tree is None or tree.n_outputs != 1:
+                raise ValueError("Only single output decision trees can be "
+                                 "compiled, got %s" % type(estimator).__name__)
+
+            is_leaf = tree.children_left < 0
+            nodes = np.arange(tree.node_count)
+
+            feature = np.asarray(estimator_features)[np.maximum(tree.feature, 0)]
+            features.append(np.where(is_leaf, -1, feature))
+            thresholds.append(tree.threshold)
+            lefts.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+            rights.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+
+            # The same normalization as DecisionTreeClassifier.predict_proba
+            value = tree.value[:, 0, :]
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            proba = np.zeros((tree.node_count, n_classes))
+            proba[:, np.asarray(estimator.classes_, dtype=int)] = value / normalizer
+            values.append(proba)
+
+            roots.append(offset)
+            offset += tree.node_count
+
+        self.feature = np.concatenate(features).astype(np.int32)
+        self.threshold = np.concatenate(thresholds).astype(np.float64)
+        self.left = np.concatenate(lefts).astype(np.int32)
+        self.right = np.concatenate(rights).astype(np.int32)
+        self.value = np.ascontiguousarray(np.concatenate(values))
+        self.roots = np.asarray(roots, dtype=np.int32)
+
+        self._lib = None
+        if engine == "c":
+            self._nodes = np.zeros(len(self.feature), dtype=_NODE_DTYPE)
+            for name in ("threshold", "feature", "left", "right"):
+                self._nodes[name] = getattr(self, name)
+            self._lib = _build_flat_trees_library()
+
+    def _leaves_numpy(self, X):
+        """Leaf of every tree for every row, shape = [n_samples, n_trees]."""
+        n_samples = X.shape[0]
+        rows = np.repeat(np.arange(n_samples), self.n_trees)
+        nodes = np.tile(self.roots, n_samples)
+        active = np.flatnonzero(self.feature[nodes] >= 0)
+
+        while active.size:
+            node = nodes[active]
+            go_left = X[rows[active], self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+            nodes[active] = node
+            active = active[self.feature[node] >= 0]
+
+        return nodes.reshape(n_samples, self.n_trees)
+
+    def _sum_block(self, X):
+        """Sum of tree probabilities for a block of rows."""
+        if self._lib is not None:
+            out = np.zeros((X.shape[0], self.n_classes))
+            self._lib.predict(X, X.shape[0], X.shape[1], self._nodes,
+                              self.roots, self.n_trees, self.value,
+                              self.n_classes, out)
+            return out
+
+        return self.value[self._leaves_numpy(X)].sum(axis=1)
+
+    def predict_proba(self, X):
+        """Predict class probabilities for X.
+
+        Parameters
+        ----------
+        X : array-like of shape = [n_samples, n_features]
+            The input samples, they are compared as float32 like in sklearn
+            trees.
+
+        Returns
+        -------
+        p : array of shape = [n_samples, n_classes]
+            Mean class probabilities of the trees.
+        """
+        X, _ = _encode_categories(X, self.categories or {},
+                                  columns=self.columns)
+        X = check_array(X, dtype=np.float32, order="C")
+
+        if self.n_features != X.shape[1]:
+            raise ValueError("Number of features of the model must "
+                             "match the input. Model n_features is {0} and "
+                             "input n_features is {1}."
+                             "".format(self.n_features, X.shape[1]))
+
+        starts = range(0, X.shape[0], self.chunk_size)
+        blocks = [X[start:start + self.chunk_size] for start in starts]
+
+        if self._lib is not None and self.n_jobs != 1 and len(blocks) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            n_threads = self.n_jobs if self.n_jobs > 0 else os.cpu_count()
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                sums = list(executor.map(self._sum_block, blocks))
+        else:
+            sums = [self._sum_block(block) for block in blocks]
+
+        if not sums:
+            return np.empty((0, self.n_classes))
+
+        return np.vstack(sums) / self.n_trees
+
+    def predict(self, X, classes=None):
+        """Predict class indices for X, or labels if classes are given."""
+        indices = np.argmax(self.predict_proba(X), axis=1)
+        return indices if classes is None else np.asarray(classes)[indices]
@@ -0,0 +1,137 @@
+"""
+Benchmark of BaggingClassifierPU parallel backends.
+
+Every configuration runs in a separate process, so peak memory of one run doesn't hide another.
+Peak RSS is the maximum of summed RSS of the process and its workers, sampled every 20 ms
+(needs psutil, otherwise maximum RSS of the process and its finished children is used).
+
+Run from "Look alike" folder:
+>>>python -m python_scripts.benchmark_bagging --n_samples 1000000 --n_jobs 1 2 4 --backend threading loky
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+
+class PeakMemory(object):
+    """Sample RSS of the current process and its children in a thread."""
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _rss(self):
+        import psutil
+
+        process = psutil.Process(os.getpid())
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        try:
+            import psutil  # noqa: F401
+        except ImportError:
+            return self
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, self._rss())
+        else:
+            import resource
+
+            # kilobytes on Linux
+            self.peak = 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def make_data(n_samples: int = 100000, n_features: int = 50, positive_share: float = 0.05, seed: int = 42):
+    """Synthetic PU data: a share of positives is labeled, the rest is unlabeled."""
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n_samples, n_features).astype(np.float32)
+    score = X[:, :5].sum(axis=1) + rng.randn(n_samples)
+    y = (score > np.quantile(score, 1 - 2 * positive_share)).astype(int)
+    y[rng.rand(n_samples) < 0.5] = 0
+
+    return X, y
+
+
+def run_single(args):
+    """Fit and score one configuration, return dict of results."""
+    from python_scripts.baggingPU import BaggingClassifierPU
+
+    X, y = make_data(args.n_samples, args.n_features)
+    max_samples = int((y == 1).sum())
+    result = {'backend': args.backend[0], 'n_jobs': args.n_jobs[0]}
+
+    with PeakMemory() as memory:
+        clf = BaggingClassifierPU(n_estimators=args.n_estimators, max_samples=max_samples,
+                                  n_jobs=args.n_jobs[0], backend=args.backend[0], oob_score=False,
+                                  random_state=0)
+        start_time = time.time()
+        clf.fit(X, y)
+        result['fit_time'] = time.time() - start_time
+
+        start_time = time.time()
+        clf.predict_proba(X)
+        result['predict_time'] = time.time() - start_time
+
+    result['peak_rss_mb'] = memory.peak / 2 ** 20
+
+    return result
+
+
+def run_all(args):
+    """Run every configuration in a new process."""
+    results = []
+    for backend in args.backend:
+        for n_jobs in args.n_jobs:
+            command = [sys.executable, '-m', 'python_scripts.benchmark_bagging', '--single',
+                       '--backend', backend, '--n_jobs', str(n_jobs),
+                       '--n_samples', str(args.n_samples), '--n_features', str(args.n_features),
+                       '--n_estimators', str(args.n_estimators)]
+            output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                                    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            results.append(json.loads(output.stdout.decode().strip().split('\n')[-1]))
+            print(results[-1])
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of BaggingClassifierPU backends.')
+    parser.add_argument('--n_samples', type=int, default=200000)
+    parser.add_argument('--n_features', type=int, default=50)
+    parser.add_argument('--n_estimators', type=int, default=32)
+    parser.add_argument('--n_jobs', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--backend', nargs='+', default=['threading', 'loky'])
+    parser.add_argument('--single', action='store_true', help='run one configuration and print json')
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_single(args)))
+    else:
+        print(run_all(args).to_string(index=False))
@@ -4,21 +4,14 @@ Processing hashed msisdn.
 There are three files. Two of them should be combined and
 intersected with the third one.
 
+Files are processed by msisdn_sets in partitions on disk, so they don't have to fit into memory.
+Run from "Look alike" folder:
+>>>python -m python_scripts.first_process
 """
-import pandas as pd
+from python_scripts.msisdn_sets import combine
 
-df1 = pd.read_csv('taxonomy/tc9d90f2.csv', header=None)
-df2 = pd.read_csv('taxonomy/t7ee4dcf.csv', header=None)
-df3 = pd.read_csv('taxonomy/t678cb3d.csv', header=None)
-df2 = df2.append(df3)
-
-df1.columns = ['hash']
-df2.columns = ['hash']
-
-s1 = set(df1['hash'].values)
-s2 = set(df2['hash'].values)
-segment_msisdn = list(s1.intersection(s2))
-
-with open('segment_msisdn.txt', 'w') as f:
-    for i in segment_msisdn:
-        f.write(i + '\n')
\ No newline at end of file
+if __name__ == '__main__':
+    combine(left=['taxonomy/tc9d90f2.csv'],
+            right=['taxonomy/t7ee4dcf.csv', 'taxonomy/t678cb3d.csv'],
+            how='intersect',
+            output_file='segment_msisdn.txt')
@@ -1,74 +1,36 @@
 """Functions to make it easier to work with H2O"""
+import os
 import h2o
 import numpy as np
 import pandas as pd
+import matplotlib.pyplot as plt
 from python_scripts.util import timeit, log
+from python_scripts.transforms import FeaturePipeline
+from python_scripts.schema import ID_COLUMNS, hive_to_h2o_type, get_col_types, read_hive_schema, \
+    get_import_params  # noqa: F401
+
 
 @timeit
-def process_df(df : pd.DataFrame() = None, cols : list = None):
+def process_df(df : pd.DataFrame() = None, cols : list = None, pipeline: FeaturePipeline = None):
+    """
+    Clip, log and transform features by rules from transforms.DEFAULT_RULES.
+
+    All transformations are evaluated on the cluster at once.
+    Pass fitted pipeline to transform scoring data the same way as training data.
+    """
     if cols is not None:
         df = df[cols]
 
-    cols_clip_min = {'cl_avg_lifetime': 0,
-                     'rc_avg_day': 0,
-                     'rc' : 0}
-
-    print('Clipping min values.')
-    # print(cols_clip_min)
-    for col in cols_clip_min.keys():
-        if col in df.columns:
-            # print(col)
-            # print(df[col].min())
-            df[df[col] < cols_clip_min[col], col] = cols_clip_min[col]
-            # print(df[col].min())
-
-    cols_clip_max = {'cl_avg_lifetime': 9000,
-                     'rc': 5000,
-                     'rc_avg_day': 100,
-                     'sms_tot_cnt': 3000,
-                     'sum_ses_mou': 200000,
-                     'mou': 10000,
-                     'avg_day_voice_cnt': 1000,
-                     'avg_day_mou': 10000,
-                     'avg_day_mbou': 5000,
-                     'sum_ses_mbou': 50000,
-                     'avg_ses_mbou': 100,
-                     'cl_onnet_cnt': 100,
-                     'cl_size': 300}
-
-    print('Clipping max values.')
-    for col in cols_clip_max.keys():
-        if col in df.columns:
-            # print(col)
-            # print(df[col].max())
-            df[df[col] >= cols_clip_max[col], col] = cols_clip_max[col]
-            # print(df[col].max())
-
-    to_log_cols = ['avg_day_data_cnt', 'rc']
-    print('Applying log transformation')
-    for col in to_log_cols:
-        if col in df.columns:
-            df[col] = df[col].log1p()
-
-    print('Applying special transformations')
-    if 'io_voice_traf_ratio' in df.columns:
-        df['io_voice_traf_ratio'] = df['io_voice_traf_ratio'] ** 0.5
-
-    if 'add_sim_cnt' in df.columns:
-        df[df['add_sim_cnt'] >= 5, 'add_sim_cnt'] = 5
-        df['add_sim_cnt'] = df['add_sim_cnt'].asfactor()
+    if pipeline is None:
+        pipeline = FeaturePipeline().fit(df.columns)
 
-    return df
+    print('Applying transformations')
+    return pipeline.transform(df)
 
 @timeit
 def generate_interaction_features(df, cols_to_use, feature):
-    for col1 in cols_to_use:
-        if col1 != feature:
-            df[col1 + '_mult_' + feature] = df[col1] * df[feature]
-            df[col1 + '_div_' + feature] = df[col1] / df[feature]
-            df[df[feature] == 0, col1 + '_div_' + feature] = 0
-
-    return df
+    rules = {'interactions': [{'feature': feature, 'columns': list(cols_to_use)}]}
+    return FeaturePipeline(rules).fit(df.columns).transform(df)
 
 @timeit
 def select_features_by_importance(model, threshold=0.0001):
@@ -82,9 +44,11 @@ def select_features_by_importance(model, threshold=0.0001):
 
 @timeit
 def train_model(model='GradientBoosting', features=[], params={}, label='', train=h2o.H2OFrame(), valid=h2o.H2OFrame(), calibrate_model=False,
-                calibration_frame=h2o.H2OFrame(), print_model=False, print_test_stats=False, test=h2o.H2OFrame()):
-    """Train model and show results."""
-    model_id = f'features_{len(features)}_' + '__'.join([f'{k}_{v}' for k, v in params.items()])
+                calibration_frame=h2o.H2OFrame(), print_model=False, print_test_stats=False, test=h2o.H2OFrame(),
+                model_id=None):
+    """Train model and show results, model_id should be unique when models are trained in parallel."""
+    if model_id is None:
+        model_id = f'features_{len(features)}_' + '__'.join([f'{k}_{v}' for k, v in params.items()])
     if model == 'GradientBoosting':
         model = h2o.estimators.gbm.H2OGradientBoostingEstimator(**params, calibrate_model=calibrate_model, calibration_frame=calibration_frame,
                                                                 model_id='gbm_'+ model_id)
@@ -134,7 +98,7 @@ def log_training(model, parameters=['ntrees', 'max_depth', 'min_rows', 'learn_ra
     
     features = ', '.join(model.varimp(True)['variable'].values)
     
-    string_to_write = f"{gbm_classifier_test.model_id}\t{actual_parameters}\t{features}\t{train_metric:.4f}\t{valid_metric:.4f}\n"
+    string_to_write = f"{model.model_id}\t{actual_parameters}\t{features}\t{train_metric:.4f}\t{valid_metric:.4f}\n"
     
     if plot_metric:
         plt.plot(model.score_history()[train_metric_name].values, label=train_metric_name);
@@ -151,7 +115,7 @@ def log_training(model, parameters=['ntrees', 'max_depth', 'min_rows', 'learn_ra
             f.write(string_to_write)
     
     if print_log:
-        print('Model_id:', gbm_classifier_test.model_id)
+        print('Model_id:', model.model_id)
         print('Actual parameters:', actual_parameters)
         print('Features:', features)
         print(f'{train_metric_name}: {train_metric}')
@@ -179,56 +143,200 @@ def prepare_data(data, n_sample, hidden_size):
 
     return data, df, df1, features
 
-@timeit
-def first_step(model, df1, features):
+def init_labels(target, rass: bool = False, destination: str = 'ys_0'):
+    """
+    Create numeric label vector for two step model.
 
-    model.train(x=list(features), y='target', training_frame=df1)
+    :param target: target column, '1' for positives
+    :param rass: if True target already contains labels -1 (unlabeled), 0 (negative) and 1 (positive),
+                 otherwise every non-positive row is unlabeled
+    :param destination: id of labels frame
+    :return: one column H2O Frame with values 1 - positive, 0 - reliable negative, -1 - unlabeled
+    """
+    if rass:
+        return h2o.assign(target.ascharacter().asnumeric(), destination)
 
-    pred = model.predict(df1)
-    df1['target'] = df1['target'].asnumeric()
-    df1['ys'] = df1['target'] * 2 - 1
-    df1 = df1.cbind(pred['p1'])
-    max_prob = df1[df1['ys'] > 0, 'p1'].max()
-    min_prob = df1[df1['ys'] > 0, 'p1'].min()
-    df1[(df1['ys'] < 0) & (df1['p1'] > max_prob), 'ys'] = 1
-    df1[(df1['ys'] < 0) & (df1['p1'] < min_prob), 'ys'] = 0
-    df1['ys'] = df1['ys'].asfactor()
+    return h2o.assign((target == '1').ifelse(1, -1), destination)
+
+
+def relabel(model, df, features, ys, y: str = 'ys', destination: str = 'ys', add_p1: bool = False):
+    """
+    One step of two step PU model.
+
+    Model is trained on df, unlabeled rows with higher probability than any positive become positive,
+    unlabeled rows with lower probability than any positive become reliable negatives.
+    Training frame isn't copied: only its "ys" column is replaced by new labels.
+    Previous labels frame and predictions are removed from the cluster.
+
+    :param model: H2O estimator
+    :param df: training frame
+    :param features: list of features
+    :param ys: labels from init_labels or previous relabel
+    :param y: response column
+    :param destination: id of new labels frame, must differ from ys id
+    :param add_p1: add predicted probability to df as "p1" column
+    :return: new labels frame and number of changed labels
+    """
+    model.train(x=list(features), y=y, training_frame=df)
+
+    pred = model.predict(df)
+    p1 = pred['p1']
+    max_prob = p1[ys > 0, :].max()
+    min_prob = p1[ys > 0, :].min()
+    new_positives = (ys < 0) & (p1 > max_prob)
+    new_negatives = (ys < 0) & (p1 < min_prob)
+    n_positives = int(new_positives.sum())
+    n_negatives = int(new_negatives.sum())
+    log(f'New positives: {n_positives}.')
+    log(f'New negatives: {n_negatives}.')
+
+    new_ys = h2o.assign(new_positives.ifelse(1, new_negatives.ifelse(0, ys)), destination)
+    df['ys'] = new_ys.asfactor()
+    if add_p1:
+        df['p1'] = p1
+    # evaluate frame so that it doesn't depend on removed frames
+    df.refresh()
+    h2o.remove(pred)
+    h2o.remove(ys)
+
+    return new_ys, n_positives + n_negatives
+
+
+def continue_training(model, df, y: str = 'ys', add_trees: int = 10):
+    """
+    Make estimator which continues training of a fitted tree model on changed labels.
+
+    Fitted GBM and DRF are continued from checkpoint with add_trees more trees, so only new trees are built.
+    Not fitted models, other algorithms and models with different response domain are returned as is
+    and are retrained from scratch.
+
+    :param model: H2O estimator
+    :param df: training frame
+    :param y: response column
+    :param add_trees: number of trees to add
+    :return: estimator to train
+    """
+    if model.algo not in ['gbm', 'drf'] or model._model_json is None:
+        return model
+
+    output = model._model_json['output']
+    if output['names'][-1] != y or list(output['domains'][-1]) != df[y].levels()[0]:
+        return model
+
+    ntrees = model.actual_params['ntrees'] + add_trees
+    params = {k: v for k, v in model._parms.items() if k not in ['model_id', 'checkpoint', 'ntrees', 'training_frame',
+                                                                 'validation_frame', 'response_column',
+                                                                 'ignored_columns']}
+    model_id = model.model_id.split('__checkpoint_')[0] + f'__checkpoint_{ntrees}'
+
+    return type(model)(checkpoint=model.model_id, ntrees=ntrees, model_id=model_id, **params)
 
-    return df1
 
 @timeit
-def second_step(model, df1, features):
-    df1['ys'] = df1['ys'].asfactor()
-    model.train(x=list(features), y='ys', training_frame=df1)
-    # df_show = orig_target.cbind(df1['target']).cbind(pred['p1'])
+def first_step(model, df1, features):
+    ys = init_labels(df1['target'])
+    ys, _ = relabel(model, df1, features, ys, y='target', destination='ys_1', add_p1=True)
+    h2o.remove(ys)
 
-    pred = model.predict(df1)['p1']
-    df1['p1'] = pred
-    df1['ys'] = df1['ys'].asnumeric()
-    # print('p1' in df1.columns)
-    max_prob = df1[df1['ys'] > 0, 'p1'].max()
-    min_prob = df1[df1['ys'] > 0, 'p1'].min()
-    df1[(df1['ys'] < 0) & (df1['p1'] > max_prob), 'ys'] = 1
-    df1[(df1['ys'] < 0) & (df1['p1'] < min_prob), 'ys'] = 0
+    return df1
 
-    df1['ys'] = df1['ys'].asfactor()
+@timeit
+def second_step(model, df1, features):
+    ys = init_labels(df1['ys'], rass=True)
+    ys, _ = relabel(model, df1, features, ys, y='ys', destination='ys_1', add_p1=True)
+    h2o.remove(ys)
 
     return df1
 
 @timeit
-def run_two_step_model(model, df1, features):
+def run_two_step_model(model, df1, features, max_steps=10, add_trees=0, min_changed=0, return_model=False):
+    """
+    Run two step PU model.
 
-    df1 = first_step(model, df1, features)
-    for _ in range(10):
-        df2 = second_step(model, df1, features)
-        if df2['ys'] == df1['ys']:
-            print('Finished')
+    :param add_trees: if > 0, GBM and DRF are continued from checkpoint with add_trees more trees each step,
+                      previous model is removed from the cluster
+    :param min_changed: stop when number of changed labels is not greater than this value
+    :param return_model: return trained model too, it differs from model when training is continued
+    :return: training frame with "ys" and "p1" columns, (frame, trained model) if return_model
+    """
+    ys = init_labels(df1['target'])
+    ys, _ = relabel(model, df1, features, ys, y='target', destination='ys_1', add_p1=True)
+    for step in range(max_steps):
+        previous_model = None
+        if add_trees > 0:
+            new_model = continue_training(model, df1, y='ys', add_trees=add_trees)
+            if new_model is not model:
+                previous_model = model
+            model = new_model
+        ys, changed = relabel(model, df1, features, ys, y='ys', destination=f'ys_{step + 2}', add_p1=True)
+        # checkpoint is not needed after the new model is trained
+        if previous_model is not None:
+            h2o.remove(previous_model.model_id)
+        if changed <= min_changed:
+            log('Finished')
             break
-        else:
-            df1 = df2.copy()
+    h2o.remove(ys)
+
+    if return_model:
+        return df1, model
 
     return df1
 
+def top_rows(df, k: int = 1000, column: str = 'p1', seed: int = 42):
+    """
+    Select k rows with the highest values of column without sorting the frame.
+
+    Threshold is found by quantile, only rows not lower than threshold are sorted. Ties on threshold
+    are broken by a random column, so exactly k rows are returned.
+
+    :param df: H2O Frame
+    :param k: number of rows
+    :param column: column to select by
+    :param seed: random seed for ties
+    :return: H2O Frame
+    """
+    n = df.nrow
+    if n <= k:
+        return df
+
+    # lower value instead of interpolation, so at least k rows are not lower than threshold
+    threshold = df[column].quantile(prob=[1 - k / n], combine_method='low')[0, 1]
+    top = df[df[column] >= threshold, :]
+    if top.nrow <= k:
+        return top
+
+    top['tiebreak'] = top[column].runif(seed=seed)
+    top = top.sort(by=[column, 'tiebreak'], ascending=[False, True])[:k, :]
+
+    return top.drop('tiebreak')
+
+
+def add_buckets(df, n_buckets: int = 10, column: str = 'p1'):
+    """
+    Add "bucket" column: 1 for the highest values of column, n_buckets for the lowest.
+
+    :param df: H2O Frame
+    :param n_buckets: number of buckets of equal size
+    :param column: column to split by
+    :return: H2O Frame
+    """
+    if n_buckets < 1:
+        raise ValueError('n_buckets must be at least 1!')
+    if n_buckets == 1:
+        df['bucket'] = 1
+        return df
+
+    probs = [1 - i / n_buckets for i in range(1, n_buckets)]
+    quantiles = df[column].quantile(prob=probs).as_data_frame().iloc[:, 1].values
+
+    bucket = 1
+    for q in quantiles:
+        bucket = bucket + (df[column] < q)
+    df['bucket'] = bucket
+
+    return df
+
+
 def cumulative_gain_curve(y_true, y_score, pos_label=None):
     """This function generates the points necessary to plot the Cumulative Gain
     Note: This implementation is restricted to the binary classification task.
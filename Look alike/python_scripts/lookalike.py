@@ -1,9 +1,14 @@
+import os
 import h2o
 import numpy as np
 import configparser
 import pandas as pd
 from python_scripts.util import timeit, log
-from python_scripts.h2o_functions import process_df, cumulative_gain_curve
+from python_scripts.metrics import precision_recall_at_k, lift_curve
+from python_scripts.transforms import FeaturePipeline
+from python_scripts.schema import get_col_types, get_import_params, read_hive_schema
+from python_scripts.h2o_functions import process_df, \
+    init_labels, relabel, continue_training, top_rows, add_buckets
 import matplotlib.pyplot as plt
 
 import time
@@ -33,43 +38,67 @@ class LookALiker(object):
             setattr(self, key, value)
         h2o.connect(ip=ip, port=port, auth=(self.login, self.password), verbose=False)
         h2o.no_progress()
+        self._import_params = {}
+        self.pipeline = None
+        # ids of whole frames transformed for scoring
+        self._transformed_frames = set()
 
     @timeit
-    def load_data_hive(self, table: str = '', col_names_df: pd.DataFrame() = None, col_names_list: list = []):
+    def load_data_hive(self, table: str = '', col_names_df: pd.DataFrame() = None, col_names_list: list = [],
+                       col_types: dict = None, columns: list = None, hive_con=None, hive_table: str = ''):
         """
         Load data from hive table into H2O dataframe.
 
+        Column types are passed to H2O explicitly, so it doesn't guess them and id columns are parsed as strings.
+        Parquet and ORC files are recognized by H2O automatically.
+
        :param table: path to table on hive.
               example: hdfs://T2-HDFS-HA-PROD/user/hive/warehouse/developers.db/al_for_segments_short
-       :param col_names_df: dataframe of column names
+       :param col_names_df: path to csv with column names (col_name) and optionally hive types (data_type)
        :param col_names_list: list of column names
+       :param col_types: dict of column names and H2O types, overrides types from schema
+       :param columns: list of columns to load, other columns are skipped while parsing
+       :param hive_con: connection to hive to read schema from metastore if column names are not defined
+       :param hive_table: hive table name to read schema, example: developers.al_for_segments_short
        :return: loaded H2O Frame
         """
         if col_names_df is not None:
-            col_names = pd.read_csv(col_names_df)['col_name'].tolist()
+            schema = pd.read_csv(col_names_df)
         elif col_names_list != []:
-            col_names = col_names_list
+            schema = pd.DataFrame({'col_name': col_names_list})
+        elif hive_con is not None:
+            schema = read_hive_schema(hive_con, hive_table)
         else:
             raise ValueError('Column names are not defined!')
 
-        self.data = h2o.import_file(path=table, destination_frame='df', col_names=col_names)
+        col_names = schema['col_name'].tolist()
+        types = get_col_types(schema)
+        if col_types is not None:
+            types.update(col_types)
+
+        # the same parameters are used to import chunks for scoring
+        self._import_params = get_import_params(col_names, types, columns)
+        self.data = h2o.import_file(path=table, destination_frame='df', **self._import_params)
 
     @timeit
     def prepare_data(self, target: str = None, to_target: str = None, n_sample: int = 10, hidden_size: int = 5,
-                     process: bool = True, rass=False):
+                     process: bool = True, rass=False, seed: int = 42):
         """
         Prepare data for model.
 
+        Data is split by target once: random unlabeled rows and hidden positives are selected
+        by one uniform random column on the cluster. Approximately n_sample unlabeled rows and
+        hidden_size hidden positives are selected.
+
        :param target:
        :param to_target:
-       :param n_sample:
-       :param hidden_size:
+       :param n_sample: number of unlabeled rows to sample
+       :param hidden_size: number of positives to hide as unlabeled for validation
        :param process:
        :param rass:
+       :param seed: random seed for sampling
        :return:
         """
-        self.hidden_size = hidden_size
-
         if not rass:
             if target is not None:
                 if target in self.data.columns:
@@ -85,48 +114,46 @@ class LookALiker(object):
                 raise ValueError('Target column not defined!')
 
             self.data['target'] = self.data['target'].asfactor()
-
-            if hidden_size == 0:
-                # sample data from negative class
-                print('Model will be trained without validation.')
-                df = self.data[self.data['target'] == '0'][:n_sample, :].rbind(self.data[self.data['target'] == '1'])
-
-            else:
-                # random sampling of positive, the rest is validation.
-                df_ = self.data[self.data['target'] == '0'][:n_sample, :].rbind(self.data[self.data['target'] == '1'])
-                self.orig_target = df_['target']
-                print('Doing random sampling')
-                target_1_len = self.data[self.data['target'] == '1'].shape[0]
-                rand_ind = np.random.choice(range(target_1_len), hidden_size, replace=False)
-
-                data_1 = self.data[self.data['target'] == '1']
-                data_1[list(rand_ind), 'target'] = '0'
-                df = self.data[self.data['target'] == '0'][:n_sample, :].rbind(data_1)
+            unlabeled = '0'
 
         else:
             self.data['target'] = self.data['target'].set_levels(['0', '1', '-1'])
+            unlabeled = '-1'
 
-            if hidden_size == 0:
-                # sample data from negative class
-                print('Model will be trained without validation.')
-                df = self.data[self.data['target'] == '-1'][:n_sample, :].rbind(self.data[self.data['target'] == '0']).rbind(self.data[self.data['target'] == '1'])
+        counts = self.data['target'].table().as_data_frame()
+        counts = dict(zip(counts.iloc[:, 0].astype(str), counts.iloc[:, 1]))
 
-            else:
-                # random sampling of positive, the rest is validation.
-                df_ = self.data[self.data['target'] == '-1'][:n_sample, :].rbind(self.data[self.data['target'] == '0']).rbind(self.data[self.data['target'] == '1'])
-                self.orig_target = df_['target']
-                print('Doing random sampling')
-                target_1_len = self.data[self.data['target'] == '1'].shape[0]
-                rand_ind = np.random.choice(range(target_1_len), hidden_size, replace=False)
+        rand = h2o.assign(self.data['target'].runif(seed=seed), 'sampling_runif')
+        # all labeled rows and a random part of unlabeled rows
+        self.sample_index = h2o.assign((self.data['target'] != unlabeled) | (
+                rand < min(n_sample / max(counts.get(unlabeled, 0), 1), 1)), 'sample_index')
+        df = self.data[self.sample_index, :]
+
+        if hidden_size == 0:
+            print('Model will be trained without validation.')
+            self.hidden_index = None
+            self.hidden_size = hidden_size
+
+        else:
+            # random positives are hidden as unlabeled, the rest is validation.
+            print('Doing random sampling')
+            hidden = (self.data['target'] == '1') & (rand < min(hidden_size / max(counts.get('1', 0), 1), 1))
+            self.hidden_index = h2o.assign(hidden[self.sample_index, :], 'hidden_index')
+            self.orig_target = h2o.deep_copy(df['target'], 'orig_target')
+            df[self.hidden_index, 'target'] = unlabeled
+            self.hidden_size = int(self.hidden_index.sum())
 
-                data_1 = self.data[self.data['target'] == '1']
-                data_1[list(rand_ind), 'target'] = '-1'
-                df = self.data[self.data['target'] == '-1'][:n_sample, :].rbind(data_1).rbind(self.data[self.data['target'] == '0'])
+        # indices are evaluated, random column isn't needed anymore
+        h2o.remove(rand)
 
         self.features = df.columns[3:-1]
 
+        # fitted pipeline transforms scoring data the same way
+        self.pipeline = None
+        self._transformed_frames = set()
         if process:
-            df = process_df(df)
+            self.pipeline = FeaturePipeline().fit(df.columns)
+            df = process_df(df, pipeline=self.pipeline)
 
         self.df = df
         self.orig_df = h2o.deep_copy(self.df, 'orig_df')
@@ -134,49 +161,53 @@ class LookALiker(object):
     @timeit
     def first_step(self):
         """
+        Train model on original target and make first labels.
 
-
-       :return:
+        Labels are kept in self.ys, training frame gets "ys" column.
         """
-        df = h2o.deep_copy(self.df, 'df_')
-        self.model.train(x=list(self.features), y='target', training_frame=df)
-
-        pred = self.model.predict(df)
-        df['target'] = df['target'].asnumeric()
-        df['ys'] = df['target'] * 2 - 1
-        df = df.cbind(pred['p1'])
-        max_prob = df[df['ys'] > 0, 'p1'].max()
-        min_prob = df[df['ys'] > 0, 'p1'].min()
-        log('New positives: {0}.'.format(df[(df['ys'] < 0) & (df['p1'] > max_prob)].shape))
-        df[(df['ys'] < 0) & (df['p1'] > max_prob), 'ys'] = 1
-        log('New negatives: {0}.'.format(df[(df['ys'] < 0) & (df['p1'] < min_prob)].shape))
-        df[(df['ys'] < 0) & (df['p1'] < min_prob), 'ys'] = 0
-        df['ys'] = df['ys'].asfactor()
-        self.df = df
+        self.ys = init_labels(self.df['target'])
+        self.ys, _ = relabel(self.model, self.df, self.features, self.ys, y='target', destination='ys_1')
 
     @timeit
-    def second_step(self):
+    def second_step(self, step: int = 0, add_trees: int = 0):
+        """
+        Train model on current labels and relabel unlabeled rows.
+
+        :param step: step number, used for id of labels frame
+        :param add_trees: if > 0, GBM and DRF are continued from checkpoint with add_trees more trees
+        :return: number of changed labels
+        """
         # self.model = h2o.estimators.glm.H2OGeneralizedLinearEstimator(family='multinomial')
-        df = h2o.deep_copy(self.df, 'df2')
-        df['ys'] = df['ys'].asfactor()
-        self.model.train(x=list(self.features), y='ys', training_frame=df)
+        if add_trees > 0:
+            model = continue_training(self.model, self.df, y='ys', add_trees=add_trees)
+            if model is not self.model:
+                self._previous_model = self.model
+            self.model = model
 
-        pred = self.model.predict(df)['p1']
-        df['p1'] = pred
-        df['ys'] = df['ys'].asnumeric()
-        max_prob = df[df['ys'] > 0, 'p1'].max()
-        min_prob = df[df['ys'] > 0, 'p1'].min()
-        log('New positives: {0}.'.format(df[(df['ys'] < 0) & (df['p1'] > max_prob)].shape))
-        df[(df['ys'] < 0) & (df['p1'] > max_prob), 'ys'] = 1
-        log('New negatives: {0}.'.format(df[(df['ys'] < 0) & (df['p1'] < min_prob)].shape))
-        df[(df['ys'] < 0) & (df['p1'] < min_prob), 'ys'] = 0
+        self.ys, changed = relabel(self.model, self.df, self.features, self.ys, y='ys',
+                                   destination=f'ys_{step + 2}')
 
-        df['ys'] = df['ys'].asfactor()
+        # checkpoint is not needed after the new model is trained
+        if getattr(self, '_previous_model', None) is not None:
+            h2o.remove(self._previous_model.model_id)
+            self._previous_model = None
 
-        return df
+        return changed
 
     @timeit
-    def run_two_step_model(self, model=None, rass=False):
+    def run_two_step_model(self, model=None, rass=False, max_steps: int = 10, add_trees: int = 0,
+                           min_changed: int = 0):
+        """
+        Run two step PU model.
+
+       :param model: H2O estimator, random forest by default
+       :param rass: target already contains reliable negatives
+       :param max_steps: maximum number of relabeling steps
+       :param add_trees: if > 0, GBM and DRF are trained from scratch only at the first step and then
+                         continued from checkpoint with add_trees more trees on changed labels
+       :param min_changed: stop when number of changed labels is not greater than this value
+       :return:
+        """
         if model is None:
             model = h2o.estimators.random_forest.H2ORandomForestEstimator(col_sample_rate_per_tree=0.9,
                                                                           ntrees=100,
@@ -187,33 +218,25 @@ class LookALiker(object):
         if not rass:
             self.first_step()
         else:
-            self.df['ys'] = self.df['target']
+            self.ys = init_labels(self.df['target'], rass=True)
+            self.df['ys'] = self.ys.asfactor()
 
-        for _ in range(10):
-            log(f'Step {_}. {time.ctime()}')
-            df2 = self.second_step()
-            if df2['ys'] == self.df['ys']:
+        for step in range(max_steps):
+            log(f'Step {step}. {time.ctime()}')
+            changed = self.second_step(step, add_trees=add_trees)
+            if changed <= min_changed:
                 log('Finished')
                 break
-            else:
-                self.df = h2o.deep_copy(df2, 'df')
-
-        # self.df = df2[df2['ys'] != '-1']
-        self.df = df2
-        # #self.df['ys'] = self.df['ys'].ascharacter()
-        # self.df['ys'] = self.df['ys'].asnumeric()
-        # self.df['ys'] = self.df['ys'].ascharacter()
-        # self.df = self.df[self.df['ys'] != '-1']
-        # self.df['ys'] = self.df['ys'].asfactor()
+
         self.change_target()
 
     @timeit
     def change_target(self):
-        # self.df['ys'] = self.df['ys'].ascharacter()
-        self.df['ys'] = self.df['ys'].asnumeric()
-        self.df['ys'] = self.df['ys'].ascharacter()
-        self.df = self.df[self.df['ys'] != '-1']
-        self.df['ys'] = self.df['ys'].asfactor()
+        """Remove unlabeled rows from training frame."""
+        self.df = h2o.assign(self.df[self.ys != -1, :], 'df_labeled')
+        self.df['ys'] = self.df['ys'].ascharacter().asfactor()
+        h2o.remove(self.ys)
+        self.ys = None
 
     @timeit
     def train_full_model(self):
@@ -231,28 +254,138 @@ class LookALiker(object):
         self.model2 = model2
 
     @timeit
-    def predict(self):
+    def save_model(self, path: str = 'models', force: bool = True):
+        """
+        Save final model and fitted feature pipeline next to it.
 
-        pr_big = self.model2.predict(self.data)
-        pr_big = pr_big.sort('p1', ascending=False)
-        df_short_ = pr_big[:1000000, :]
-        df_short_ = df_short_['msisdn']
-        h2o.export_file(df_short_, 'hdfs://T2-HDFS-HA-PROD/user/andrey.lukyanenko/exported.csv')
+        :param path: folder for the model, pipeline is written as <model path>_pipeline.json,
+                     so the folder should be visible from this machine
+        :param force: overwrite existing files
+        :return: model path
+        """
+        model_path = h2o.save_model(self.model2, path=path, force=force)
+        if self.pipeline is not None:
+            self.pipeline.save(model_path + '_pipeline.json')
+
+        return model_path
 
     @timeit
-    def plot_hidded_validation(self):
+    def load_model(self, model_path: str = ''):
+        """
+        Load final model and feature pipeline saved by save_model.
+
+        :param model_path: path returned by save_model
+        """
+        self.model2 = h2o.load_model(model_path)
+        pipeline_path = model_path + '_pipeline.json'
+        self.pipeline = FeaturePipeline.load(pipeline_path) if os.path.exists(pipeline_path) else None
+
+    def _transform(self, chunk):
+        """Transform chunk by fitted pipeline inplace."""
+        if self.pipeline is None:
+            return chunk
+
+        return self.pipeline.transform(chunk)
+
+    def _score_chunks(self, data=None, chunk_size: int = None):
+        """
+        Yield chunks of data for scoring and flag whether chunk should be removed after scoring.
+
+        Chunks are transformed by the pipeline fitted in prepare_data. Chunks of a frame and imported files
+        are new frames and are removed after scoring. Whole frame is transformed inplace once, without a copy.
+
+        :param data: H2O Frame or list of paths to files with the same structure as loaded table
+        :param chunk_size: number of rows in chunk for H2O Frame, whole frame is scored if None
+        """
+        if data is None:
+            data = self.data
+
+        if isinstance(data, (list, tuple)):
+            for path in data:
+                yield self._transform(h2o.import_file(path=path, **self._import_params)), True
+        elif chunk_size:
+            for start in range(0, data.nrow, chunk_size):
+                yield self._transform(data[start:start + chunk_size, :]), True
+        else:
+            if data.frame_id not in self._transformed_frames:
+                data = self._transform(data)
+                self._transformed_frames.add(data.frame_id)
+            yield data, False
+
+    @timeit
+    def predict(self, path: str, data=None, top_k: int = 1000000, columns: list = ['msisdn'],
+                n_buckets: int = 10, file_format: str = 'csv', parts: int = 1, local: bool = False,
+                chunk_size: int = None):
+        """
+        Score data and export top_k rows with the highest probability, sorted by probability.
+
+        Top rows are selected by quantile threshold in every chunk and then among candidates,
+        so full frame is never sorted.
+
+       :param path: path to export, hdfs or local path on H2O cluster; local path on this machine if local is True
+       :param data: H2O Frame or list of paths to files (parts of the table), self.data by default.
+                    Files are imported, scored and removed one by one, so data can be larger than cluster memory.
+       :param top_k: number of rows to export
+       :param columns: columns to export with probability and bucket
+       :param n_buckets: number of probability buckets, 1 is the best
+       :param file_format: 'csv' or 'parquet'
+       :param parts: number of part files for export from H2O, -1 to let H2O decide. Path should be a directory
+       :param local: download result and write it on this machine, parquet is partitioned by bucket
+       :param chunk_size: number of rows scored at once for H2O Frame
+       :return: H2O Frame with exported rows
+        """
+        candidates = None
+        for i, (chunk, temporary) in enumerate(self._score_chunks(data, chunk_size)):
+            pred = self.model2.predict(chunk)
+            scored = h2o.assign(top_rows(chunk[columns].cbind(pred['p1']), top_k), f'top_candidates_{i}')
+            h2o.remove(pred)
+            if temporary:
+                h2o.remove(chunk)
+
+            if candidates is None:
+                candidates = scored
+            else:
+                merged = h2o.assign(candidates.rbind(scored), f'top_merged_{i}')
+                h2o.remove(candidates)
+                h2o.remove(scored)
+                candidates = merged
+
+        # only top_k rows are sorted
+        top = add_buckets(top_rows(candidates, top_k), n_buckets).sort('p1', ascending=False)
+
+        if local:
+            top_df = top.as_data_frame()
+            if file_format == 'parquet':
+                top_df.to_parquet(path, partition_cols=['bucket'], index=False)
+            else:
+                top_df.to_csv(path, index=False)
+        else:
+            h2o.export_file(top, path, force=True, parts=parts, format=file_format)
+
+        return top
+
+    def _validation_scores(self):
+        """
+        Score validation frame and download scores with labels.
+
+        :return: pd.DataFrame with columns p1, target (true target) and train_target (target with hidden positives)
+        """
         pred = self.model2.predict(self.orig_df)
-        df_show = self.orig_target.cbind(self.orig_df['target']).cbind(pred['p1'])
-        ts = range(100, self.hidden_size, 100)
-        y_std = []
-        y_ = []
-        df_ = df_show[df_show['target0'] == '0'].sort('p1', ascending=False)
-        goods = df_[df_['target'] == '1'].shape[0]
-        for t in ts:
-            df_small = df_.head(t)
-            rate = df_small[df_small['target'] == '1'].shape[0] / df_small.shape[0]
-            y_std.append(rate)
-            y_.append(df_small[df_small['target'] == '1'].shape[0] / goods)
+        df_show = pred['p1'].cbind(self.orig_target).cbind(self.orig_df['target']).as_data_frame()
+        h2o.remove(pred)
+        df_show.columns = ['p1', 'target', 'train_target']
+        df_show['target'] = df_show['target'].astype(str)
+        df_show['train_target'] = df_show['train_target'].astype(str)
+
+        return df_show
+
+    @timeit
+    def plot_hidded_validation(self):
+        df_show = self._validation_scores()
+        ts = np.arange(100, self.hidden_size, 100)
+        # hidden positives are searched among unlabeled rows
+        df_ = df_show.loc[df_show['train_target'] == '0']
+        y_std, y_ = precision_recall_at_k(df_['target'].values, df_['p1'].values, ts, pos_label='1')
 
         # Performance graphing
         fig, ax1 = plt.subplots(figsize=(16, 12))
@@ -277,27 +410,9 @@ class LookALiker(object):
     def plot_lift(self):
         lift = self.model2.gains_lift().as_data_frame()
 
-        pred = self.model2.predict(self.orig_df)
-        df_show = self.orig_target.cbind(self.orig_df['target']).cbind(pred['p1'])
-
-        pd_df = df_show[['p1', 'target']].as_data_frame()
-        percentages, gains2 = cumulative_gain_curve(pd_df['target'].values, pd_df['p1'].values, 1)
-
-        goods = df_show[(df_show['target'] == '1')].shape[0]
-        df_show = df_show.sort('p1', ascending=False)
-        y_s = []
-        y_s1 = []
-        tf1 = [i * df_show.shape[0] for i in lift.cumulative_data_fraction.values]
-        tf1 = [int(np.round(i)) for i in tf1]
-        for t in tf1:
-            df__ = df_show[:t, :]
-            df_small = df__[df__['target'] == '1']
-            rate = df_small.shape[0] / goods
-            y_s.append(rate)
-            rate1 = df_small.shape[0] / t
-            y_s1.append(rate1)
-            del df_small
-            del rate
+        df_show = self._validation_scores()
+        _, y_s, y_s1 = lift_curve(df_show['target'].values, df_show['p1'].values,
+                                  lift.cumulative_data_fraction.values, pos_label='1')
 
         data_p = []
         data_p.append(go.Scatter(
@@ -0,0 +1,223 @@
+"""Metrics for ranking models calculated locally with numpy."""
+import numpy as np
+
+
+def precision_recall_at_k(y_true, y_score, ks, pos_label=1):
+    """This function calculates precision and recall of top k rows for several k
+    with one sort.
+    Args:
+        y_true (array-like, shape (n_samples)): True labels of the data.
+        y_score (array-like, shape (n_samples)): Target scores.
+        ks (array-like of int): Numbers of top rated rows.
+        pos_label (int or str, default=1): Label considered as positive.
+    Returns:
+        precision (numpy.ndarray): Share of positives among top k rows for every k.
+        recall (numpy.ndarray): Share of all positives found in top k rows for every k.
+    """
+    y_true, y_score = np.asarray(y_true), np.asarray(y_score)
+    y_true = (y_true == pos_label)
+
+    sorted_indices = np.argsort(y_score, kind='stable')[::-1]
+    hits = np.concatenate([[0], np.cumsum(y_true[sorted_indices])])
+
+    ks = np.clip(np.asarray(ks, dtype=np.int64), 0, len(y_true))
+    found = hits[ks]
+
+    precision = found / np.maximum(ks, 1)
+    recall = found / max(hits[-1], 1)
+
+    return precision, recall
+
+
+def lift_curve(y_true, y_score, fractions, pos_label=1):
+    """This function calculates cumulative lift and gain at given fractions of data.
+    Args:
+        y_true (array-like, shape (n_samples)): True labels of the data.
+        y_score (array-like, shape (n_samples)): Target scores.
+        fractions (array-like of float): Fractions of top rated rows, from 0 to 1.
+        pos_label (int or str, default=1): Label considered as positive.
+    Returns:
+        lift (numpy.ndarray): Cumulative lift for every fraction.
+        gains (numpy.ndarray): Share of all positives found for every fraction.
+        precision (numpy.ndarray): Share of positives among top rows for every fraction.
+    """
+    y_true = np.asarray(y_true)
+    ks = np.round(np.asarray(fractions) * len(y_true)).astype(np.int64)
+    precision, gains = precision_recall_at_k(y_true, y_score, ks, pos_label)
+
+    base_rate = np.mean(y_true == pos_label) if len(y_true) else 0
+    lift = precision / base_rate if base_rate > 0 else np.zeros_like(precision)
+
+    return lift, gains, precision
+
+
+class GainSketch(object):
+    """
+    Histogram of scores for approximate cumulative gain and lift on big data.
+
+    Scores are counted in n_bins equal bins, separately for all rows and positives, so data can be
+    processed in chunks and sketches from several workers can be merged. Gain inside a bin is
+    interpolated linearly, error of gain is not greater than share of positives in one bin,
+    it is returned by curve(). Rows with NaN scores are not counted in the curve, their number is kept
+    in n_missing. For small data use cumulative_gain_curve or exact_curve().
+
+    Example:
+    --------
+    >>>sketch = GainSketch()
+    >>>for y_true, y_score in chunks:
+    >>>    sketch.update(y_true, y_score)
+    >>>fractions, gains, lift, error = sketch.curve(np.linspace(0.01, 1, 100))
+    """
+
+    def __init__(self, n_bins: int = 10000, score_range: tuple = (0., 1.), pos_label=1):
+        """
+        Parameters:
+        -----------
+        n_bins : int
+            number of bins, error decreases with more bins
+        score_range : tuple
+            minimum and maximum score, scores outside are counted in the edge bins
+        pos_label : int or str
+            label considered as positive
+        """
+        self.n_bins = n_bins
+        self.score_range = score_range
+        self.pos_label = pos_label
+        self.total = np.zeros(n_bins, dtype=np.int64)
+        self.positives = np.zeros(n_bins, dtype=np.int64)
+        self.n_missing = 0
+
+    def update(self, y_true, y_score):
+        """Add chunk of labels and scores, rows with NaN scores are only counted in n_missing."""
+        y_true, y_score = np.asarray(y_true), np.asarray(y_score, dtype=np.float64)
+        missing = np.isnan(y_score)
+        if missing.any():
+            self.n_missing += int(missing.sum())
+            y_true, y_score = y_true[~missing], y_score[~missing]
+        low, high = self.score_range
+        bins = ((y_score - low) / (high - low) * self.n_bins).astype(np.int64)
+        bins = np.clip(bins, 0, self.n_bins - 1)
+
+        self.total += np.bincount(bins, minlength=self.n_bins)
+        self.positives += np.bincount(bins, weights=(y_true == self.pos_label),
+                                      minlength=self.n_bins).astype(np.int64)
+
+        return self
+
+    def merge(self, other):
+        """Add counts from sketch with the same bins, for example calculated by another worker."""
+        if other.n_bins != self.n_bins or tuple(other.score_range) != tuple(self.score_range):
+            raise ValueError('Sketches have different bins!')
+        self.total += other.total
+        self.positives += other.positives
+        self.n_missing += other.n_missing
+
+        return self
+
+    def curve(self, fractions):
+        """
+        Calculate cumulative gain and lift.
+
+        Args:
+            fractions (array-like of float): Fractions of top rated rows, from 0 to 1.
+        Returns:
+            fractions (numpy.ndarray): Requested fractions.
+            gains (numpy.ndarray): Share of all positives found for every fraction.
+            lift (numpy.ndarray): Cumulative lift for every fraction.
+            error (numpy.ndarray): Maximum absolute error of gain for every fraction.
+        """
+        fractions = np.asarray(fractions, dtype=np.float64)
+        n, n_positives = self.total.sum(), self.positives.sum()
+        if n == 0 or n_positives == 0:
+            zeros = np.zeros_like(fractions)
+            return fractions, zeros, zeros, zeros
+
+        # the highest scores first
+        total = self.total[::-1]
+        positives = self.positives[::-1]
+        cum_total = np.concatenate([[0], np.cumsum(total)])
+        cum_positives = np.concatenate([[0], np.cumsum(positives)])
+
+        k = fractions * n
+        bins = np.clip(np.searchsorted(cum_total, k, side='right') - 1, 0, self.n_bins - 1)
+        inside = (k - cum_total[bins]) / np.maximum(total[bins], 1)
+        found = cum_positives[bins] + np.clip(inside, 0, 1) * positives[bins]
+
+        gains = found / n_positives
+        lift = np.divide(gains, fractions, out=np.zeros_like(gains), where=fractions > 0)
+        error = np.where(inside > 0, positives[bins] / n_positives, 0)
+
+        return fractions, gains, lift, error
+
+
+def exact_curve(y_true, y_score, fractions, pos_label=1):
+    """This function calculates exact cumulative gain and lift at given fractions of data.
+    Args:
+        y_true (array-like, shape (n_samples)): True labels of the data.
+        y_score (array-like, shape (n_samples)): Target scores.
+        fractions (array-like of float): Fractions of top rated rows, from 0 to 1.
+        pos_label (int or str, default=1): Label considered as positive.
+    Returns:
+        fractions, gains, lift, error: The same as GainSketch.curve, error is zero.
+    """
+    fractions = np.asarray(fractions, dtype=np.float64)
+    lift, gains, _ = lift_curve(y_true, y_score, fractions, pos_label)
+
+    return fractions, gains, lift, np.zeros_like(gains)
+
+
+def h2o_chunks(df, label: str = 'target', score: str = 'p1', chunk_size: int = 1000000):
+    """
+    Download labels and scores from H2O Frame in chunks.
+
+    :param df: H2O Frame
+    :param label: label column
+    :param score: score column
+    :param chunk_size: number of rows in chunk
+    :return: generator of (labels, scores) arrays
+    """
+    for start in range(0, df.nrow, chunk_size):
+        chunk = df[start:start + chunk_size, [label, score]].as_data_frame()
+        yield chunk[label].values, chunk[score].values
+
+
+def parquet_chunks(path: str = '', label: str = 'target', score: str = 'p1', chunk_size: int = 1000000):
+    """
+    Read labels and scores from parquet file in chunks.
+
+    :param path: path to parquet file
+    :param label: label column
+    :param score: score column
+    :param chunk_size: number of rows in chunk
+    :return: generator of (labels, scores) arrays
+    """
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=[label, score]):
+        yield batch.column(label).to_numpy(zero_copy_only=False), batch.column(score).to_numpy(zero_copy_only=False)
+
+
+def gain_curve(chunks, fractions, exact: bool = False, n_bins: int = 10000, score_range: tuple = (0., 1.),
+               pos_label=1):
+    """
+    Calculate cumulative gain and lift from chunks of data.
+
+    :param chunks: iterable of (labels, scores), e.g. h2o_chunks or parquet_chunks
+    :param fractions: fractions of top rated rows, from 0 to 1
+    :param exact: concatenate all chunks and sort, only for data which fits into memory
+    :param n_bins: number of bins for approximate calculation
+    :param score_range: minimum and maximum score
+    :param pos_label: label considered as positive
+    :return: fractions, gains, lift and error
+    """
+    if exact:
+        chunks = list(chunks)
+        y_true = np.concatenate([c[0] for c in chunks])
+        y_score = np.concatenate([c[1] for c in chunks])
+        return exact_curve(y_true, y_score, fractions, pos_label)
+
+    sketch = GainSketch(n_bins, score_range, pos_label)
+    for y_true, y_score in chunks:
+        sketch.update(y_true, y_score)
+
+    return sketch.curve(fractions)
@@ -0,0 +1,300 @@
+"""
+Set operations on big files of hashed msisdn.
+
+Hashes are read in chunks and stored as fixed-width binary digests: hex hashes are decoded into bytes
+(16 bytes for md5), other strings are stored as bytes of fixed width. Digests are kept in NumPy arrays
+of uint64 words, so sorting and comparison are vectorized and 100M hashes take 1.6 GB instead of tens
+of GB of Python strings.
+
+Inputs larger than memory are hash-partitioned on disk: every input file is split into n_partitions
+binary files by splitmix64 hash of all words of digests, so raw strings with common prefixes are spread
+evenly too. Then every partition is sorted and merged separately.
+Files and partitions are processed by several processes.
+
+Example:
+--------
+>>>combine(['taxonomy/tc9d90f2.csv'], ['taxonomy/t7ee4dcf.csv', 'taxonomy/t678cb3d.csv'],
+>>>        how='intersect', output_file='segment_msisdn.txt')
+
+Run from "Look alike" folder:
+>>>python -m python_scripts.msisdn_sets intersect --left a.csv --right b.csv c.csv --output segment_msisdn.txt
+"""
+import os
+import re
+import shutil
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from python_scripts.util import timeit, log
+
+HOW = ['intersect', 'union', 'difference']
+_HEX = re.compile('^[0-9a-fA-F]+$')
+
+
+def detect_encoding(file_name: str = '', n_rows: int = 1000):
+    """
+    Detect encoding of hashes by the first rows of a file.
+
+    :param file_name: csv file without header, hashes in the first column
+    :param n_rows: number of rows to check
+    :return: ('hex', number of bytes) if all hashes are hex of the same length ('HEX' if they are in upper case),
+        otherwise ('raw', 64)
+    """
+    values = pd.read_csv(file_name, header=None, usecols=[0], dtype=str, nrows=n_rows)[0].dropna().str.strip()
+    lengths = values.str.len().unique()
+    if len(values) and len(lengths) == 1 and lengths[0] % 2 == 0 and values.str.match(_HEX).all():
+        return 'HEX' if values.str.isupper().all() else 'hex', int(lengths[0] // 2)
+
+    return 'raw', 64
+
+
+def encode(values, width: int = 16, encoding: str = 'hex'):
+    """
+    Convert hashes into digests.
+
+    :param values: array-like of str
+    :param width: number of bytes of a digest
+    :param encoding: 'hex' or 'HEX' to decode hex strings, 'raw' to use bytes of strings
+    :return: np.ndarray of shape (n, ceil(width / 8)) of uint64, rows are compared as bytes
+    """
+    values = np.asarray(values, dtype=str)
+    n_words = -(-width // 8)
+    digests = np.zeros((len(values), n_words * 8), dtype=np.uint8)
+
+    if encoding in ('hex', 'HEX'):
+        if len(values) and (np.char.str_len(values) != 2 * width).any():
+            raise ValueError(f'All hex hashes must have {2 * width} characters!')
+        try:
+            data = bytes.fromhex(''.join(values))
+        except ValueError:
+            raise ValueError('Hashes are not hex, use encoding="raw"!')
+        # fromhex skips whitespace
+        if len(data) != width * len(values):
+            raise ValueError('Hashes are not hex, use encoding="raw"!')
+        digests[:, :width] = np.frombuffer(data, dtype=np.uint8).reshape(-1, width)
+    elif encoding == 'raw':
+        raw = np.char.encode(values, 'utf-8')
+        if raw.dtype.itemsize > width:
+            raise ValueError(f'Hashes are longer than {width} bytes!')
+        # trailing bytes are zero
+        digests[:, :raw.dtype.itemsize] = raw.view(np.uint8).reshape(len(values), -1)
+    else:
+        raise ValueError("encoding must be 'hex', 'HEX' or 'raw'")
+
+    # big-endian words keep byte order of digests
+    return digests.view('>u8').astype(np.uint64)
+
+
+def decode(words, width: int = 16, encoding: str = 'hex'):
+    """
+    Convert digests back into lines of text.
+
+    :param words: digests from encode
+    :param width: number of bytes of a digest
+    :param encoding: 'hex', 'HEX' (upper case) or 'raw'
+    :return: bytes, one hash per line
+    """
+    if len(words) == 0:
+        return b''
+
+    digests = words.astype('>u8').view(np.uint8).reshape(len(words), -1)[:, :width]
+
+    if encoding in ('hex', 'HEX'):
+        hex_string = digests.tobytes().hex()
+        hex_string = hex_string.upper() if encoding == 'HEX' else hex_string
+        hex_digits = np.frombuffer(hex_string.encode(), dtype=np.uint8).reshape(len(words), -1)
+        lines = np.hstack([hex_digits, np.full((len(words), 1), ord('\n'), dtype=np.uint8)])
+        return lines.tobytes()
+
+    return b''.join(digest.rstrip(b'\0') + b'\n' for digest in np.ascontiguousarray(digests).view(f'V{width}')
+                    .ravel().tolist())
+
+
+def partition_ids(words, n_partitions: int = 64):
+    """
+    Partition of every digest by splitmix64 hash of all its words.
+
+    :param words: digests from encode
+    :param n_partitions: number of partitions
+    :return: np.ndarray of partition ids
+    """
+    h = np.zeros(len(words), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i in range(words.shape[1]):
+            x = (h ^ words[:, i]) + np.uint64(0x9E3779B97F4A7C15)
+            x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+            x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+            h = x ^ (x >> np.uint64(31))
+
+    return h % np.uint64(n_partitions)
+
+
+def _sort_unique(words):
+    """Sorted unique rows."""
+    if len(words) == 0:
+        return words
+    words = words[np.lexsort(words.T[::-1])]
+    keep = np.ones(len(words), dtype=bool)
+    keep[1:] = (words[1:] != words[:-1]).any(axis=1)
+
+    return words[keep]
+
+
+def merge(left, right, how: str = 'intersect'):
+    """
+    Set operation on sorted unique digests with one sort.
+
+    :param left, right: digests from _sort_unique
+    :param how: 'intersect', 'union' or 'difference' (left without right)
+    :return: sorted unique digests
+    """
+    both = np.concatenate([left, right])
+    side = np.concatenate([np.zeros(len(left), dtype=np.uint64), np.ones(len(right), dtype=np.uint64)])
+    # digests first, then side, so equal digest from left is just before the right one
+    order = np.lexsort((side,) + tuple(both.T[::-1]))
+    both, side = both[order], side[order]
+
+    same_as_next = np.zeros(len(both), dtype=bool)
+    same_as_next[:-1] = (both[1:] == both[:-1]).all(axis=1)
+
+    if how == 'intersect':
+        return both[same_as_next]
+    if how == 'union':
+        same_as_previous = np.zeros(len(both), dtype=bool)
+        same_as_previous[1:] = same_as_next[:-1]
+        return both[~same_as_previous]
+    if how == 'difference':
+        return both[(side == 0) & ~same_as_next]
+
+    raise ValueError(f'how must be one of {HOW}')
+
+
+def _partition_file(file_name, folder, prefix, n_partitions, chunk_size, width, encoding):
+    """Split hashes of one file into binary partition files, return number of rows."""
+    n_rows = 0
+    partitions = [open(os.path.join(folder, f'{prefix}_{p}.bin'), 'wb') for p in range(n_partitions)]
+    try:
+        for i, chunk in enumerate(pd.read_csv(file_name, header=None, usecols=[0], dtype=str, chunksize=chunk_size)):
+            try:
+                words = encode(chunk[0].dropna().str.strip().values, width, encoding)
+            except ValueError as e:
+                raise ValueError(f'{file_name}, rows {i * chunk_size}-{(i + 1) * chunk_size}: {e}')
+            partition = partition_ids(words, n_partitions)
+            order = np.argsort(partition, kind='stable')
+            bounds = np.searchsorted(partition[order], np.arange(n_partitions + 1))
+            words = words[order]
+            for p in range(n_partitions):
+                words[bounds[p]:bounds[p + 1]].tofile(partitions[p])
+            n_rows += len(words)
+    finally:
+        for f in partitions:
+            f.close()
+
+    return n_rows
+
+
+def _read_partition(folder, prefixes, p, n_words):
+    """Digests of one partition of several files."""
+    parts = [np.fromfile(os.path.join(folder, f'{prefix}_{p}.bin'), dtype=np.uint64).reshape(-1, n_words)
+             for prefix in prefixes]
+    return _sort_unique(np.concatenate(parts)) if parts else np.zeros((0, n_words), dtype=np.uint64)
+
+
+def _merge_partition(folder, left_prefixes, right_prefixes, p, how, width, encoding):
+    """Merge one partition and write it as text, return number of hashes."""
+    n_words = -(-width // 8)
+    result = merge(_read_partition(folder, left_prefixes, p, n_words),
+                   _read_partition(folder, right_prefixes, p, n_words), how)
+    with open(os.path.join(folder, f'result_{p}.txt'), 'wb') as f:
+        f.write(decode(result, width, encoding))
+
+    return len(result)
+
+
+@timeit
+def combine(left: list = None, right: list = None, how: str = 'intersect', output_file: str = 'result.txt',
+            encoding: str = 'auto', width: int = None, n_partitions: int = 64, chunk_size: int = 5000000,
+            n_jobs: int = 4, temp_folder: str = None):
+    """
+    Set operation of two groups of hash files, every group is the union of its files.
+
+    :param left: list of csv files without header, hashes in the first column
+    :param right: list of csv files
+    :param how: 'intersect', 'union' or 'difference' (left without right)
+    :param output_file: text file with one hash per line
+    :param encoding: 'hex' (written in lower case), 'HEX' (upper case), 'raw' or 'auto' to detect by every file
+    :param width: number of bytes of a digest, detected if None
+    :param n_partitions: number of partitions on disk, one partition of all files should fit into memory
+    :param chunk_size: number of rows read at once
+    :param n_jobs: number of processes
+    :param temp_folder: folder for partitions, system temporary folder if None
+    :return: number of hashes in the result
+    """
+    if how not in HOW:
+        raise ValueError(f'how must be one of {HOW}')
+    left, right = list(left or []), list(right or [])
+    if not left and not right:
+        raise ValueError('No input files!')
+
+    if encoding == 'raw' and width is None:
+        width = 64
+    if encoding == 'auto' or width is None:
+        detected = {file_name: detect_encoding(file_name) for file_name in left + right}
+        # case of hex doesn't change digests, output case is taken from the first file
+        kinds = {(e.lower() if e != 'raw' else e, w) for e, w in detected.values()}
+        if len(kinds) > 1:
+            raise ValueError(f'Files have different encodings, set encoding and width: {detected}')
+        detected_encoding, detected_width = detected[(left + right)[0]]
+        encoding = detected_encoding if encoding == 'auto' else encoding
+        width = width or detected_width
+    log(f'Encoding {encoding}, {width} bytes per hash.')
+
+    folder = tempfile.mkdtemp(prefix='msisdn_sets_', dir=temp_folder)
+    try:
+        files = [(f'left{i}', file_name) for i, file_name in enumerate(left)] + \
+                [(f'right{i}', file_name) for i, file_name in enumerate(right)]
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            n_rows = list(executor.map(_partition_file, [file_name for _, file_name in files],
+                                       [folder] * len(files), [prefix for prefix, _ in files],
+                                       [n_partitions] * len(files), [chunk_size] * len(files),
+                                       [width] * len(files), [encoding] * len(files)))
+            for (_, file_name), rows in zip(files, n_rows):
+                log(f'{file_name}: {rows} hashes.')
+
+            left_prefixes = [prefix for prefix, _ in files if prefix.startswith('left')]
+            right_prefixes = [prefix for prefix, _ in files if prefix.startswith('right')]
+            counts = list(executor.map(_merge_partition, [folder] * n_partitions,
+                                       [left_prefixes] * n_partitions, [right_prefixes] * n_partitions,
+                                       range(n_partitions), [how] * n_partitions,
+                                       [width] * n_partitions, [encoding] * n_partitions))
+
+        with open(output_file, 'wb') as output:
+            for p in range(n_partitions):
+                with open(os.path.join(folder, f'result_{p}.txt'), 'rb') as f:
+                    shutil.copyfileobj(f, output)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    log(f'{sum(counts)} hashes are written to {output_file}.')
+
+    return sum(counts)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Set operations on files of hashed msisdn.')
+    parser.add_argument('how', choices=HOW)
+    parser.add_argument('--left', nargs='+', required=True)
+    parser.add_argument('--right', nargs='+', default=[])
+    parser.add_argument('--output', default='result.txt')
+    parser.add_argument('--encoding', default='auto', choices=['auto', 'hex', 'HEX', 'raw'])
+    parser.add_argument('--n_partitions', type=int, default=64)
+    parser.add_argument('--n_jobs', type=int, default=4)
+    parser.add_argument('--temp_folder', default=None)
+    args = parser.parse_args()
+
+    combine(args.left, args.right, args.how, args.output, encoding=args.encoding,
+            n_partitions=args.n_partitions, n_jobs=args.n_jobs, temp_folder=args.temp_folder)
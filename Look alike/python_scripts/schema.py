@@ -0,0 +1,80 @@
+"""Table schema helpers for H2O import, they don't need H2O connection."""
+import pandas as pd
+
+# columns which look numeric, but are identifiers
+ID_COLUMNS = ['msisdn', 'subs_id']
+
+
+def hive_to_h2o_type(hive_type: str = ''):
+    """Map hive column type to H2O column type."""
+    hive_type = hive_type.lower().split('(')[0].strip()
+    if hive_type in ['tinyint', 'smallint', 'int', 'integer', 'bigint', 'float', 'double', 'decimal']:
+        return 'numeric'
+    if hive_type in ['timestamp', 'date']:
+        return 'time'
+    return 'enum'
+
+
+def get_col_types(schema: pd.DataFrame = None, id_columns: list = ID_COLUMNS):
+    """
+    Make H2O column types from table schema.
+
+    :param schema: dataframe with columns col_name and data_type (output of hive "describe")
+    :param id_columns: columns which are always parsed as strings
+    :return: dict of column names and H2O types
+    """
+    if 'data_type' in schema.columns:
+        col_types = {col: hive_to_h2o_type(t) for col, t in zip(schema['col_name'], schema['data_type'])}
+    else:
+        col_types = {}
+    for col in schema['col_name']:
+        if col in id_columns:
+            col_types[col] = 'string'
+
+    return col_types
+
+
+def read_hive_schema(con=None, table: str = ''):
+    """
+    Read table schema from hive metastore.
+
+    :param con: DB-API connection to hive, for example pyhive.hive.connect(...)
+    :param table: table name, for example developers.al_for_segments_short
+    :return: dataframe with columns col_name and data_type
+    """
+    cursor = con.cursor()
+    cursor.execute(f'describe {table}')
+    schema = pd.DataFrame(cursor.fetchall(), columns=[d[0] for d in cursor.description])
+    schema = schema[['col_name', 'data_type']]
+    schema['col_name'] = schema['col_name'].str.strip()
+    # partition information is separated by an empty line and starts with "#"
+    empty = schema.index[schema['col_name'].isin(['', '# Partition Information'])]
+    if len(empty) > 0:
+        schema = schema.loc[:empty[0] - 1]
+
+    return schema.reset_index(drop=True)
+
+
+def get_import_params(col_names: list = None, col_types: dict = None, columns: list = None):
+    """
+    Make parameters of h2o.import_file for a subset of columns.
+
+    With skipped_columns H2O expects names and types only of parsed columns.
+
+    :param col_names: all column names of the file
+    :param col_types: dict of column names and H2O types
+    :param columns: list of columns to load, all columns if None
+    :return: dict with col_names, col_types and skipped_columns
+    """
+    col_types = col_types or {}
+    skipped_columns = None
+    if columns is not None:
+        missing = set(columns) - set(col_names)
+        if missing:
+            raise ValueError(f'Columns {missing} not found!')
+        skipped_columns = [i for i, col in enumerate(col_names) if col not in columns]
+        col_names = [col for col in col_names if col in columns]
+        col_types = {col: t for col, t in col_types.items() if col in columns}
+
+    return dict(col_names=col_names, col_types=col_types if col_types else None,
+                skipped_columns=skipped_columns or None)
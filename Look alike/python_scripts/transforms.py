@@ -0,0 +1,207 @@
+"""Feature transformations which work the same way for H2O and pandas dataframes."""
+import json
+
+import numpy as np
+import pandas as pd
+
+# rules used by h2o_functions.process_df
+DEFAULT_RULES = {
+    'clip_min': {'cl_avg_lifetime': 0,
+                 'rc_avg_day': 0,
+                 'rc': 0},
+    'clip_max': {'cl_avg_lifetime': 9000,
+                 'rc': 5000,
+                 'rc_avg_day': 100,
+                 'sms_tot_cnt': 3000,
+                 'sum_ses_mou': 200000,
+                 'mou': 10000,
+                 'avg_day_voice_cnt': 1000,
+                 'avg_day_mou': 10000,
+                 'avg_day_mbou': 5000,
+                 'sum_ses_mbou': 50000,
+                 'avg_ses_mbou': 100,
+                 'cl_onnet_cnt': 100,
+                 'cl_size': 300},
+    'log': ['avg_day_data_cnt', 'rc'],
+    'power': {'io_voice_traf_ratio': 0.5},
+    'factor_max': {'add_sim_cnt': 5},
+    'interactions': []
+}
+
+
+def _factor_levels(x):
+    """Numeric values as H2O factor levels, NaN stays missing."""
+    levels = x.astype(str).astype(object)
+    integral = np.isfinite(x) & (x == np.round(x))
+    levels[integral] = x[integral].astype(np.int64).astype(str)
+    levels[np.isnan(x)] = None
+
+    return levels
+
+
+class FeaturePipeline(object):
+    """
+    Declarative feature transformations.
+
+    Rules are applied to every column in the fixed order: clip_min, clip_max, log, power, factor_max.
+    After that interaction features are added. For H2O all transformations of a frame are built
+    as one lazy expression, which is evaluated on the cluster once. For pandas the same
+    transformations are vectorized.
+
+    Rules:
+    ------
+    clip_min, clip_max : dict
+        column: value. Values lower than clip_min or not lower than clip_max are replaced by the value
+    log : list
+        columns to transform with log1p
+    power : dict
+        column: power
+    factor_max : dict
+        column: value. Values not lower than the value are replaced by it, column is made categorical
+    interactions : list of dicts
+        {'feature': feature, 'columns': columns}. For every column adds column_mult_feature
+        and column_div_feature (0 when feature is 0)
+
+    Example:
+    --------
+    >>>pipeline = FeaturePipeline().fit(df.columns)
+    >>>pipeline.save('pipeline.json')
+    >>>df = pipeline.transform(df)
+    >>>pd_df = FeaturePipeline.load('pipeline.json').transform(pd_df)
+    """
+
+    def __init__(self, rules: dict = None):
+        """
+        Parameters:
+        -----------
+        rules : dict
+            transformation rules, DEFAULT_RULES if None
+        """
+        self.rules = {k: v for k, v in (DEFAULT_RULES if rules is None else rules).items()}
+        self.steps = None
+        self.interactions = []
+
+    def fit(self, columns):
+        """
+        Select rules for existing columns.
+
+        :param columns: column names of training frame
+        :return: self
+        """
+        columns = list(columns)
+        steps = {}
+        for rule in ['clip_min', 'clip_max', 'power', 'factor_max']:
+            for col, value in self.rules.get(rule, {}).items():
+                if col in columns:
+                    steps.setdefault(col, []).append([rule, value])
+        for col in self.rules.get('log', []):
+            if col in columns:
+                steps.setdefault(col, []).append(['log', None])
+
+        order = ['clip_min', 'clip_max', 'log', 'power', 'factor_max']
+        self.steps = {col: sorted(col_steps, key=lambda step: order.index(step[0]))
+                      for col, col_steps in steps.items()}
+
+        self.interactions = []
+        for interaction in self.rules.get('interactions', []):
+            feature = interaction['feature']
+            if feature in columns:
+                self.interactions.append([feature, [col for col in interaction['columns']
+                                                    if col in columns and col != feature]])
+
+        return self
+
+    def transform(self, df):
+        """
+        Apply transformations.
+
+        :param df: H2O Frame or pd.DataFrame
+        :return: transformed dataframe of the same type, H2O Frame is changed inplace
+        """
+        if self.steps is None:
+            raise ValueError('Pipeline is not fitted!')
+
+        if isinstance(df, pd.DataFrame):
+            return self._transform_pandas(df)
+
+        return self._transform_h2o(df)
+
+    def _transform_h2o(self, df):
+        """Build transformations as one expression and evaluate it."""
+        for col, col_steps in self.steps.items():
+            x = df[col]
+            for rule, value in col_steps:
+                if rule == 'clip_min':
+                    x = (x < value).ifelse(value, x)
+                elif rule in ['clip_max', 'factor_max']:
+                    x = (x >= value).ifelse(value, x)
+                elif rule == 'log':
+                    x = x.log1p()
+                elif rule == 'power':
+                    x = x ** value
+                if rule == 'factor_max':
+                    x = x.asfactor()
+            df[col] = x
+
+        for feature, columns in self.interactions:
+            is_zero = df[feature] == 0
+            for col in columns:
+                df[col + '_mult_' + feature] = df[col] * df[feature]
+                df[col + '_div_' + feature] = is_zero.ifelse(0, df[col] / df[feature])
+
+        # nothing was sent to the cluster yet
+        df.refresh()
+
+        return df
+
+    def _transform_pandas(self, df):
+        """Apply transformations to a copy of pandas dataframe."""
+        df = df.copy()
+        for col, col_steps in self.steps.items():
+            x = df[col].values.astype(np.float64)
+            for rule, value in col_steps:
+                if rule == 'clip_min':
+                    x = np.where(x < value, value, x)
+                elif rule in ['clip_max', 'factor_max']:
+                    x = np.where(x >= value, value, x)
+                elif rule == 'log':
+                    x = np.log1p(x)
+                elif rule == 'power':
+                    x = x ** value
+            if any(rule == 'factor_max' for rule, _ in col_steps):
+                # levels are strings like in H2O: 5.0 becomes '5'
+                df[col] = pd.Categorical(_factor_levels(x))
+            else:
+                df[col] = x
+
+        for feature, columns in self.interactions:
+            f = df[feature].values.astype(np.float64)
+            x = df[columns].values.astype(np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                div = np.where(f[:, None] == 0, 0, x / f[:, None])
+            new = pd.DataFrame(np.hstack([x * f[:, None], div]), index=df.index,
+                               columns=[col + '_mult_' + feature for col in columns] +
+                                       [col + '_div_' + feature for col in columns])
+            df = pd.concat([df.drop(columns=new.columns, errors='ignore'), new], axis=1)
+
+        return df
+
+    def to_dict(self):
+        """Fitted pipeline as dict."""
+        return {'rules': self.rules, 'steps': self.steps, 'interactions': self.interactions}
+
+    def save(self, file_name: str = 'pipeline.json'):
+        """Save fitted pipeline to json."""
+        with open(file_name, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, file_name: str = 'pipeline.json'):
+        """Load fitted pipeline from json."""
+        with open(file_name) as f:
+            params = json.load(f)
+        pipeline = cls(params['rules'])
+        pipeline.steps = params['steps']
+        pipeline.interactions = params['interactions']
+
+        return pipeline
@@ -0,0 +1,178 @@
+"""Hyperparameter search for H2O models."""
+import json
+import time
+import sqlite3
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import h2o
+import numpy as np
+import pandas as pd
+from python_scripts.util import timeit, log
+from python_scripts.h2o_functions import train_model
+
+
+def _to_float(metric):
+    """Metric for SQLite, None is written as NULL."""
+    return float(metric) if metric is not None else None
+
+
+def _format_metric(metric):
+    return f'{metric:.4f}' if metric is not None else 'None'
+
+
+class ParamSearch(object):
+    """
+    Hyperparameter search around h2o_functions.train_model.
+
+    Several models are trained on the cluster at the same time, each configuration is identified by
+    hash of its parameters, features, label, model type and ids of training and validation frames.
+    Results are written into SQLite table, configurations which are already in the table are skipped,
+    so search can be stopped and continued.
+
+    Example:
+    --------
+    >>>search = ParamSearch('search.db', metric='auc', parallelism=4)
+    >>>configs = search.random_configs({'ntrees': [100, 200], 'max_depth': [5, 7, 9]}, n_configs=5)
+    >>>search.run(configs, features, 'target', train, valid)
+    >>>search.results().sort_values('valid_metric')
+    """
+
+    def __init__(self, db_file_name: str = 'search.db', metric: str = 'auc', parallelism: int = 2,
+                 model: str = 'GradientBoosting'):
+        """
+        Parameters:
+        -----------
+        db_file_name : str
+            SQLite file with results
+        metric : str
+            name of H2O model metric method, e.g. auc, logloss, rmse
+        parallelism : int
+            number of models trained at the same time
+        model : str
+            model type for train_model
+        """
+        self.db_file_name = db_file_name
+        self.metric = metric
+        self.parallelism = parallelism
+        self.model = model
+        self.models = {}
+
+        with sqlite3.connect(self.db_file_name) as con:
+            con.execute("""create table if not exists results (
+                               config_hash text primary key,
+                               model_id text,
+                               params text,
+                               features text,
+                               label text,
+                               metric text,
+                               train_metric real,
+                               valid_metric real,
+                               train_time real,
+                               created text)""")
+
+    @staticmethod
+    def random_configs(grid: dict = None, n_configs: int = 10, seed: int = 42):
+        """
+        Sample random configurations from grid without repetitions.
+
+        :param grid: dict of parameter names and lists of values
+        :param n_configs: number of configurations
+        :param seed: random seed
+        :return: list of dicts
+        """
+        names = sorted(grid.keys())
+        all_configs = list(itertools.product(*[grid[name] for name in names]))
+        rng = np.random.RandomState(seed)
+        chosen = rng.choice(len(all_configs), min(n_configs, len(all_configs)), replace=False)
+
+        return [dict(zip(names, all_configs[i])) for i in chosen]
+
+    @staticmethod
+    def config_hash(params: dict = None, features: list = None, label: str = '', model: str = '',
+                    train_id: str = None, valid_id: str = None):
+        """Hash of configuration, new data or model type give new hash."""
+        config = json.dumps({'params': params, 'features': sorted(features), 'label': label, 'model': model,
+                             'train_id': train_id, 'valid_id': valid_id},
+                            sort_keys=True, default=str)
+        return hashlib.md5(config.encode('utf-8')).hexdigest()
+
+    def _done(self):
+        """Hashes of configurations already in results."""
+        with sqlite3.connect(self.db_file_name) as con:
+            return {row[0] for row in con.execute('select config_hash from results')}
+
+    def _train(self, config_hash, params, features, label, train, valid):
+        """Train one model and calculate metrics, model id contains config hash, so parallel models don't clash."""
+        start_time = time.time()
+        model = train_model(model=self.model, features=features, params=params, label=label,
+                            train=train, valid=valid, model_id=f'search_{config_hash}')
+        train_time = time.time() - start_time
+
+        metric = getattr(model, self.metric)
+        # metric is None without validation frame
+        return model, metric(train=True), metric(valid=True) if valid is not None else None, train_time
+
+    @timeit
+    def run(self, configs: list = None, features: list = None, label: str = '', train=None, valid=None,
+            keep_models: bool = False):
+        """
+        Train models for all new configurations.
+
+        :param configs: list of parameter dicts for train_model
+        :param features: list of features
+        :param label: target column
+        :param train: training H2O Frame
+        :param valid: validation H2O Frame
+        :param keep_models: keep trained models in self.models, otherwise they are removed from cluster
+        :return: results table
+        """
+        done = self._done()
+        todo = {}
+        train_id = train.frame_id if train is not None else None
+        valid_id = valid.frame_id if valid is not None else None
+        model_name = self.model if isinstance(self.model, str) else type(self.model).__name__
+        for params in configs:
+            config_hash = self.config_hash(params, features, label, model_name, train_id, valid_id)
+            if config_hash not in done:
+                todo[config_hash] = params
+        log(f'{len(configs) - len(todo)} configurations are already done, {len(todo)} to train.')
+
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = {executor.submit(self._train, config_hash, params, features, label, train, valid): config_hash
+                       for config_hash, params in todo.items()}
+            for future in as_completed(futures):
+                config_hash = futures[future]
+                try:
+                    model, train_metric, valid_metric, train_time = future.result()
+                    self._write(config_hash, model.model_id, todo[config_hash], features, label,
+                                train_metric, valid_metric, train_time)
+                except Exception as e:
+                    log(f'Configuration {todo[config_hash]} failed: {e}')
+                    continue
+
+                log(f'{model.model_id}: {self.metric} {_format_metric(train_metric)} / '
+                    f'{_format_metric(valid_metric)}.')
+                if keep_models:
+                    self.models[config_hash] = model
+                else:
+                    h2o.remove(model.model_id)
+
+        return self.results()
+
+    def _write(self, config_hash, model_id, params, features, label, train_metric, valid_metric, train_time):
+        """Write one result row."""
+        with sqlite3.connect(self.db_file_name) as con:
+            con.execute('insert or replace into results values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (config_hash, model_id, json.dumps(params, sort_keys=True, default=str),
+                         json.dumps(list(features)), label, self.metric, _to_float(train_metric),
+                         _to_float(valid_metric), train_time, time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    def results(self):
+        """All results as pd.DataFrame, parameters are expanded into columns with "param_" prefix."""
+        with sqlite3.connect(self.db_file_name) as con:
+            results = pd.read_sql('select * from results', con)
+        params = pd.DataFrame([json.loads(p) for p in results['params']], index=results.index).add_prefix('param_')
+
+        return results.join(params)
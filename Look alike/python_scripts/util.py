@@ -1,31 +1,222 @@
 import os
+import sys
+import json
 import time
 import pickle
+import functools
+import threading
 from typing import Any
 
-nesting_level = 0
-is_start = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# logging state is kept per thread, so parallel jobs don't break nesting
+_local = threading.local()
+
+
+def _max_rss():
+    """Peak resident memory of the process in bytes."""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _h2o_used_memory():
+    """Memory used on H2O cluster in bytes, None if there is no connection."""
+    try:
+        import h2o
+        return sum(node['max_mem'] - node['free_mem'] for node in h2o.cluster().nodes)
+    except Exception:
+        return None
+
+
+class Profiler(object):
+    """
+    Tree of spans of functions decorated with timeit.
+
+    Every thread has its own stack of open spans, so spans of parallel jobs don't mix. A span keeps
+    wall and CPU time of its thread, increase of peak RSS of the process and optionally change of memory
+    used on H2O cluster. When profiler is disabled timeit only checks one flag.
+    Spans from worker processes can be saved to json and loaded into one profiler.
+
+    Example:
+    --------
+    >>>profiler.enable(h2o_memory=True)
+    >>>model.run_two_step_model(...)
+    >>>profiler.to_chrome_trace('trace.json')  # open in chrome://tracing or Perfetto
+    >>>profiler.aggregate().head(10)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.h2o_memory = False
+        self.spans = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def enable(self, h2o_memory: bool = False):
+        """Start collecting spans, h2o_memory adds two requests to H2O cluster per span."""
+        self.h2o_memory = h2o_memory
+        self.enabled = True
+
+    def disable(self):
+        """Stop collecting spans, collected spans are kept."""
+        self.enabled = False
+
+    def clear(self):
+        """Remove collected spans."""
+        with self._lock:
+            self.spans = []
+
+    def _stack(self):
+        if not hasattr(_local, 'spans'):
+            _local.spans = []
+        return _local.spans
+
+    def start(self, name: str):
+        """Open span in the current thread."""
+        stack = self._stack()
+        with self._lock:
+            span_id = self._next_id
+            self._next_id += 1
+
+        span = {'id': span_id,
+                'parent': stack[-1]['id'] if stack else None,
+                'name': name,
+                'depth': len(stack),
+                'pid': os.getpid(),
+                'thread': threading.current_thread().name,
+                'tid': threading.get_ident(),
+                'start': time.time(),
+                '_wall': time.perf_counter(),
+                '_cpu': time.thread_time(),
+                '_rss': _max_rss(),
+                '_h2o': _h2o_used_memory() if self.h2o_memory else None}
+        stack.append(span)
+
+        return span
+
+    def stop(self, span: dict, error: bool = False):
+        """Close span and add it to collected spans."""
+        span['wall'] = time.perf_counter() - span.pop('_wall')
+        span['cpu'] = time.thread_time() - span.pop('_cpu')
+        span['rss_delta'] = _max_rss() - span.pop('_rss')
+        h2o_start = span.pop('_h2o')
+        h2o_end = _h2o_used_memory() if h2o_start is not None else None
+        span['h2o_delta'] = h2o_end - h2o_start if h2o_end is not None else None
+        span['error'] = error
+
+        stack = self._stack()
+        if stack and stack[-1] is span:
+            stack.pop()
+
+        with self._lock:
+            self.spans.append(span)
+
+    def to_json(self, file_name: str = 'profile.json'):
+        """Save spans to json."""
+        with open(file_name, 'w') as f:
+            json.dump(self.spans, f)
+
+    def load(self, file_name: str = 'profile.json'):
+        """Add spans saved by to_json, e.g. by another process or run."""
+        with open(file_name) as f:
+            spans = json.load(f)
+        with self._lock:
+            self.spans.extend(spans)
+
+        return self
+
+    def to_chrome_trace(self, file_name: str = 'trace.json'):
+        """Save spans in Chrome trace event format."""
+        events = [{'name': span['name'], 'ph': 'X', 'pid': span['pid'], 'tid': span['tid'],
+                   'ts': span['start'] * 1e6, 'dur': span['wall'] * 1e6,
+                   'args': {'cpu_sec': span['cpu'],
+                            'rss_delta_mb': span['rss_delta'] / 2 ** 20,
+                            'h2o_delta_mb': (span['h2o_delta'] / 2 ** 20
+                                             if span['h2o_delta'] is not None else None)}}
+                  for span in self.spans]
+        with open(file_name, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def aggregate(self):
+        """
+        Statistics by function name.
+
+        Self time is wall time minus wall time of child spans in the same thread.
+
+        :return: pd.DataFrame sorted by total wall time
+        """
+        import pandas as pd
+
+        columns = ['name', 'calls', 'wall', 'self_wall', 'cpu', 'mean_wall', 'max_rss_delta_mb', 'errors']
+        if not self.spans:
+            return pd.DataFrame(columns=columns)
+
+        spans = pd.DataFrame(self.spans)
+        # ids are unique inside one process of one run
+        prefix = spans['run'].astype(str) + ':' if 'run' in spans else ''
+        prefix = prefix + spans['pid'].astype(str) + ':'
+        has_parent = spans['parent'].notna()
+        parent_keys = prefix[has_parent] + spans.loc[has_parent, 'parent'].astype(int).astype(str)
+        children_wall = spans.loc[has_parent, 'wall'].groupby(parent_keys.values).sum()
+        keys = prefix + spans['id'].astype(str)
+        spans['self_wall'] = spans['wall'] - keys.map(children_wall).fillna(0)
+
+        result = spans.groupby('name').agg(calls=('wall', 'size'), wall=('wall', 'sum'),
+                                           self_wall=('self_wall', 'sum'), cpu=('cpu', 'sum'),
+                                           mean_wall=('wall', 'mean'), max_rss_delta=('rss_delta', 'max'),
+                                           errors=('error', 'sum'))
+        result['max_rss_delta_mb'] = result.pop('max_rss_delta') / 2 ** 20
+
+        return result.reset_index()[columns].sort_values('wall', ascending=False)
+
+    @classmethod
+    def from_runs(cls, file_names: list = None):
+        """Load spans of several runs saved by to_json, aggregate() then sums all runs."""
+        profiler = cls()
+        for run, file_name in enumerate(file_names):
+            with open(file_name) as f:
+                spans = json.load(f)
+            for span in spans:
+                span['run'] = run
+            profiler.spans.extend(spans)
+
+        return profiler
+
+
+profiler = Profiler()
 
 
 def timeit(method):
+    @functools.wraps(method)
     def timed(*args, **kw):
-        global is_start
-        global nesting_level
-
-        if not is_start:
+        if not getattr(_local, 'is_start', None):
             print()
 
-        is_start = True
+        _local.is_start = True
         log("Start {}.".format(method.__name__))
-        nesting_level += 1
+        _local.nesting_level = getattr(_local, 'nesting_level', 0) + 1
 
+        span = profiler.start(method.__qualname__) if profiler.enabled else None
         start_time = time.time()
-        result = method(*args, **kw)
-        end_time = time.time()
+        error = True
+        try:
+            result = method(*args, **kw)
+            error = False
+        finally:
+            # state is restored on errors too, so next calls in this thread are not nested
+            end_time = time.time()
+            _local.nesting_level -= 1
+            _local.is_start = False
+            if span is not None:
+                profiler.stop(span, error=error)
 
-        nesting_level -= 1
         log("End {}. Time: {:0.2f} sec.".format(method.__name__, end_time - start_time))
-        is_start = False
 
         return result
 
@@ -33,6 +224,5 @@ def timeit(method):
 
 
 def log(entry: Any):
-    global nesting_level
-    space = "." * (4 * nesting_level)
-    print("{}{}".format(space, entry))
\ No newline at end of file
+    space = "." * (4 * getattr(_local, 'nesting_level', 0))
+    print("{}{}".format(space, entry))
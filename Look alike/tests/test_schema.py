@@ -0,0 +1,48 @@
+import inspect
+
+import pandas as pd
+import pytest
+from python_scripts.schema import get_col_types, get_import_params
+
+COL_NAMES = ['msisdn', 'target', 'rc', 'mou', 'sms_tot_cnt']
+COL_TYPES = {'msisdn': 'string', 'rc': 'numeric', 'mou': 'numeric'}
+
+
+def test_all_columns():
+    params = get_import_params(COL_NAMES, COL_TYPES)
+
+    assert params == {'col_names': COL_NAMES, 'col_types': COL_TYPES, 'skipped_columns': None}
+
+
+def test_column_subset():
+    params = get_import_params(COL_NAMES, COL_TYPES, ['mou', 'msisdn'])
+
+    # names and types only of parsed columns, in file order
+    assert params == {'col_names': ['msisdn', 'mou'],
+                      'col_types': {'msisdn': 'string', 'mou': 'numeric'},
+                      'skipped_columns': [1, 2, 4]}
+
+
+def test_subset_without_types():
+    params = get_import_params(COL_NAMES, None, ['target'])
+
+    assert params == {'col_names': ['target'], 'col_types': None, 'skipped_columns': [0, 2, 3, 4]}
+
+
+def test_missing_columns():
+    with pytest.raises(ValueError, match='unknown'):
+        get_import_params(COL_NAMES, COL_TYPES, ['msisdn', 'unknown'])
+
+
+def test_col_types_from_schema():
+    schema = pd.DataFrame({'col_name': ['msisdn', 'rc', 'region', 'report_date'],
+                           'data_type': ['bigint', 'decimal(10,2)', 'varchar(100)', 'date']})
+
+    assert get_col_types(schema) == {'msisdn': 'string', 'rc': 'numeric', 'region': 'enum', 'report_date': 'time'}
+
+
+def test_h2o_import_file_accepts_params():
+    h2o = pytest.importorskip('h2o')
+    params = get_import_params(COL_NAMES, COL_TYPES, ['msisdn', 'mou'])
+
+    inspect.signature(h2o.import_file).bind(path='hdfs://table', destination_frame='df', **params)
@@ -0,0 +1,401 @@
+"""Benchmark of Teradata loaders against a local database stand-in.
+
+Measures fast_tdsql.select, turbodbc_load.td_load_df and FastLoad path (fastloader_create script)
+on generated subscriber dataframes without the warehouse. Loaders are called as they are,
+the stand-in only replaces the drivers:
+- teradatasql and turbodbc modules are replaced in sys.modules by stand-in modules, so every loader
+  runs even if the drivers are not installed;
+- SQLite (or DuckDB if installed) file database with attached UAT_DM schema;
+- Teradata only parts of statements (MULTISET, NO FALLBACK, PRIMARY INDEX, SEL) are rewritten;
+- FastLoad utility is replaced by reading the script written by ready_write and loading
+  the data file in CHECKPOINT sized batches.
+
+Every path reports rows/s, MB/s of dataframe memory and peak memory increase, results can be appended
+to a csv file to track them over time. A failed path is reported with its error and the rest are run.
+Without psutil peak memory is measured by tracemalloc in a second run, so it doesn't slow down the timed run.
+
+Examples:
+---------
+Run from repository root:
+>>>python -m Tele2_BDA.db_loaders.benchmark_loaders --rows 10000 100000 1000000 --out loaders.csv
+"""
+
+import os
+import re
+import sys
+import csv
+import time
+import types
+import sqlite3
+import importlib
+import tracemalloc
+import argparse
+import tempfile
+import threading
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+
+def generate_subscribers(n_rows=100000, na_share=0.05, seed=42):
+    """
+    Generate dataframe similar to subscriber tables.
+
+    Parameters:
+    -----------
+    n_rows - number of rows;
+    na_share - share of NA values in float, string and date columns;
+    seed - random seed;
+    """
+    rng = np.random.RandomState(seed)
+    msisdn = 79000000000 + rng.randint(0, 999999999, n_rows).astype(np.int64)
+    subs_id = 200000000000 + np.arange(n_rows, dtype=np.int64)
+
+    df = pd.DataFrame({
+        'msisdn': pd.Series(msisdn.astype(str), dtype=object),
+        'subs_id': pd.Series(subs_id.astype(str), dtype=object),
+        'lifetime': rng.randint(0, 9000, n_rows).astype(np.int32),
+        'sms_cnt': rng.poisson(30, n_rows).astype(np.int64),
+        'arpu': rng.gamma(2, 200, n_rows),
+        'data_mb': rng.lognormal(7, 1.5, n_rows),
+        'tariff': pd.Categorical(rng.choice(['Мой онлайн', 'Мой разговор', 'Классический', 'Black'], n_rows)),
+        'region': pd.Series(rng.choice(['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург'], n_rows),
+                            dtype=object),
+        'activation_date': pd.Timestamp('2010-01-01') + pd.to_timedelta(rng.randint(0, 3000, n_rows), unit='D'),
+    })
+
+    for col in ['arpu', 'data_mb', 'region', 'activation_date']:
+        df.loc[rng.rand(n_rows) < na_share, col] = None
+
+    return df
+
+
+def _frame_mb(df):
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
+class PeakMemory(object):
+    """Peak RSS increase of the process sampled in a thread, None if psutil is not installed."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self, process, start):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process.memory_info().rss - start)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        try:
+            import psutil
+        except ImportError:
+            return self
+        self.peak = 0
+        process = psutil.Process(os.getpid())
+        self._thread = threading.Thread(target=self._run, args=(process, process.memory_info().rss), daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+
+
+def _tracemalloc_peak(function, *args):
+    """Peak memory allocated by python during the call."""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Teradata statement parts which the stand-in doesn't understand
+_TERADATA_SYNTAX = [
+    (re.compile(r'\bMULTISET\b', re.I), ''),
+    (re.compile(r',\s*NO FALLBACK|,\s*NO BEFORE JOURNAL|,\s*NO AFTER JOURNAL|,\s*CHECKSUM\s*=\s*DEFAULT', re.I), ''),
+    (re.compile(r'\)\s*PRIMARY INDEX\s*\([^)]*\)', re.I), ')'),
+    (re.compile(r'^\s*SEL\s', re.I), 'SELECT '),
+]
+
+
+def to_standin_sql(q):
+    """Rewrite Teradata only syntax."""
+    for pattern, replacement in _TERADATA_SYNTAX:
+        q = pattern.sub(replacement, q)
+    return q
+
+
+class StandInCursor(object):
+    """
+    Cursor with the parts of teradatasql and turbodbc cursors used by the loaders.
+
+    description has python types of the first not NULL values as types, like teradatasql.
+    """
+
+    def __init__(self, connection, database_error=Exception):
+        self._cursor = connection.cursor()
+        self._database_error = database_error
+        self._rows = []
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._cursor.close()
+
+    def execute(self, q, params=None):
+        try:
+            self._cursor.execute(to_standin_sql(q), params or ())
+        except Exception as e:
+            raise self._database_error(str(e))
+
+        self._rows = self._cursor.fetchall() if self._cursor.description else []
+        if self._cursor.description:
+            types = []
+            for i, col in enumerate(self._cursor.description):
+                value = next((row[i] for row in self._rows if row[i] is not None), '')
+                types.append(type(value))
+            self.description = [(col[0], col_type) for col, col_type in zip(self._cursor.description, types)]
+        else:
+            self.description = None
+
+    def fetchall(self):
+        return self._rows
+
+    def executemanycolumns(self, q, columns):
+        """Insert columns of values, like turbodbc."""
+        rows = list(zip(*[np.asarray(values).tolist() for values in columns]))
+        try:
+            # one transaction per batch, like a bulk insert
+            self._cursor.execute('BEGIN')
+            self._cursor.executemany(to_standin_sql(q), rows)
+            self._cursor.execute('COMMIT')
+        except Exception as e:
+            raise self._database_error(str(e))
+
+
+class StandInDatabaseError(Exception):
+    """Error raised by stand-in drivers."""
+
+
+class StandInConnection(object):
+    """Connection to a local database file with UAT_DM schema."""
+
+    def __init__(self, path, engine='sqlite', database_error=Exception):
+        self.path = path
+        self.engine = engine
+        self.database_error = database_error
+        if engine == 'duckdb':
+            import duckdb
+            self._connection = duckdb.connect(path)
+        else:
+            # transactions are opened by the cursor
+            self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute(f"ATTACH DATABASE '{path}.uat_dm' AS UAT_DM")
+
+    def cursor(self):
+        return StandInCursor(self._connection, self.database_error)
+
+    def close(self):
+        self._connection.close()
+
+
+# loaders are imported again inside standin_drivers, so they bind stand-in drivers
+_LOADERS = ['Tele2_BDA.wrappers.fast_tdsql', 'Tele2_BDA.db_loaders.turbodbc_load']
+
+
+@contextlib.contextmanager
+def standin_drivers(path, engine='sqlite'):
+    """
+    Replace teradatasql and turbodbc modules by stand-in modules connected to the local database.
+
+    Installed drivers are replaced too, original modules are restored on exit.
+
+    Parameters:
+    -----------
+    path - database file;
+    engine - 'sqlite' or 'duckdb';
+    """
+    def connect(*args, **kwargs):
+        return StandInConnection(path, engine, StandInDatabaseError)
+
+    teradatasql = types.ModuleType('teradatasql')
+    teradatasql.connect = connect
+    teradatasql.DatabaseError = teradatasql.OperationalError = StandInDatabaseError
+
+    turbodbc = types.ModuleType('turbodbc')
+    turbodbc.connect = connect
+    turbodbc.make_options = lambda **kwargs: kwargs
+    turbodbc.DatabaseError = StandInDatabaseError
+
+    saved = {name: sys.modules.get(name) for name in ['teradatasql', 'turbodbc'] + _LOADERS}
+    for name in _LOADERS:
+        sys.modules.pop(name, None)
+    sys.modules['teradatasql'] = teradatasql
+    sys.modules['turbodbc'] = turbodbc
+    try:
+        yield
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+def run_select(con, table, n_rows):
+    """fast_tdsql.select of the whole table."""
+    fast_tdsql = importlib.import_module('Tele2_BDA.wrappers.fast_tdsql')
+
+    df = fast_tdsql.select(con, f'SEL * FROM {table}', shape=False)
+    assert len(df) == n_rows
+
+    return df
+
+
+def run_td_load_df(df, table_name):
+    """turbodbc_load.td_load_df with the stand-in turbodbc."""
+    turbodbc_load = importlib.import_module('Tele2_BDA.db_loaders.turbodbc_load')
+
+    with contextlib.redirect_stdout(None):
+        # td_load_df doesn't accept NA values and changes columns inplace
+        turbodbc_load.td_load_df(df.copy(), dsn='StandIn', table_name=table_name)
+
+
+def run_fastload(df, con, folder, table_name, checkpoint=100000):
+    """
+    Write data file and FastLoad script with fastloader_create.ready_write and replay the script.
+
+    Like FastLoad all columns are loaded as VARCHAR, rows are inserted in CHECKPOINT batches.
+    """
+    from Tele2_BDA.db_loaders import fastloader_create
+
+    data_file = os.path.join(folder, 'fastload_data.txt')
+    script_file = os.path.join(folder, 'fastload_script.txt')
+    df.to_csv(data_file, sep='\t', header=False, index=False)
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        with contextlib.redirect_stdout(None):
+            fastloader_create.ready_write(host='standin', login='bench', password='', cols=list(df.columns),
+                                          file_name=os.path.basename(data_file), table_name=table_name,
+                                          checkpoint=str(checkpoint),
+                                          fastload_file_name=os.path.basename(script_file))
+    finally:
+        os.chdir(cwd)
+
+    with open(script_file) as f:
+        script = f.read()
+    cols = re.findall(r'^(\w+) \(VARCHAR\(\d+\)\),$', script, re.M)
+    table = re.search(r'^BEGIN LOADING (\S+)', script, re.M).group(1)
+    checkpoint = int(re.search(r'^CHECKPOINT (\d+);', script, re.M).group(1))
+    separator = re.search(r'VARTEXT "([^"]*)"', script).group(1).encode().decode('unicode_escape')
+    file_name = re.search(r'^FILE (.*);$', script, re.M).group(1).split('\\')[-1]
+
+    with con.cursor() as cur:
+        try:
+            cur.execute(f'DROP TABLE {table}')
+        except Exception:
+            pass
+        cur.execute(f'CREATE TABLE {table} (' + ','.join(f'{col} VARCHAR(255)' for col in cols) + ')')
+        insert = f'INSERT INTO {table} VALUES (' + ','.join('?' for _ in cols) + ')'
+        with open(os.path.join(folder, file_name), newline='') as f:
+            reader = csv.reader(f, delimiter=separator)
+            while True:
+                batch = [row for _, row in zip(range(checkpoint), reader)]
+                if not batch:
+                    break
+                cur.executemanycolumns(insert, list(zip(*batch)))
+
+
+def _measure(path_name, n_rows, frame_mb, function, *args):
+    with PeakMemory() as memory:
+        start_time = time.time()
+        function(*args)
+        seconds = time.time() - start_time
+
+    # tracemalloc slows down allocations, so it isn't used in the timed run
+    peak = memory.peak if memory.peak is not None else _tracemalloc_peak(function, *args)
+
+    return {'path': path_name, 'rows': n_rows, 'seconds': seconds, 'rows_per_sec': n_rows / seconds,
+            'mb_per_sec': frame_mb / seconds, 'peak_memory_mb': peak / 2 ** 20, 'error': ''}
+
+
+def benchmark(rows=(10000, 100000), engine='sqlite', paths=('select', 'td_load_df', 'fastload'), folder=None):
+    """
+    Run all paths for all scales.
+
+    Parameters:
+    -----------
+    rows - numbers of rows of generated dataframes;
+    engine - 'sqlite' or 'duckdb';
+    paths - paths to measure, failed paths are reported with error and the rest are run;
+    folder - folder for database and FastLoad files, temporary folder if None;
+    """
+    results = []
+    with tempfile.TemporaryDirectory(dir=folder) as tmp:
+        for n_rows in rows:
+            df = generate_subscribers(n_rows)
+            frame_mb = _frame_mb(df)
+            path = os.path.join(tmp, f'standin_{n_rows}.db')
+            con = StandInConnection(path, engine)
+
+            # td_load_df and teradatasql types don't support NA values
+            filled = df.fillna({'arpu': 0, 'data_mb': 0, 'region': '',
+                                'activation_date': pd.Timestamp('1900-01-01')})
+
+            # table for select is loaded without measuring
+            table = 'UAT_DM.BENCH_SELECT'
+            sql_types = {'i': 'INTEGER', 'f': 'REAL'}
+            with con.cursor() as cur:
+                cur.execute(f'CREATE TABLE {table} (' +
+                            ','.join(f'{col} {sql_types.get(filled[col].dtype.kind, "TEXT")}'
+                                     for col in filled.columns) + ')')
+                cur.executemanycolumns(f'INSERT INTO {table} VALUES (' + ','.join('?' for _ in filled.columns) + ')',
+                                       [filled[col].values if filled[col].dtype.kind in sql_types
+                                        else filled[col].astype(str).values for col in filled.columns])
+
+            runs = {'select': (run_select, con, table, n_rows),
+                    'td_load_df': (run_td_load_df, filled, 'BENCH_TD_LOAD_DF'),
+                    'fastload': (run_fastload, df, con, tmp, 'UAT_DM.BENCH_FASTLOAD')}
+            with standin_drivers(path, engine):
+                for path_name in paths:
+                    function, *args = runs[path_name]
+                    try:
+                        result = _measure(path_name, n_rows, frame_mb, function, *args)
+                    except Exception as e:
+                        result = {'path': path_name, 'rows': n_rows, 'error': f'{type(e).__name__}: {e}'}
+                    print(result)
+                    results.append(result)
+
+            con.close()
+
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of Teradata loaders against a local stand-in.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--engine', default='sqlite', choices=['sqlite', 'duckdb'])
+    parser.add_argument('--paths', nargs='+', default=['select', 'td_load_df', 'fastload'])
+    parser.add_argument('--out', default='', help='csv file to append results to')
+    args = parser.parse_args()
+
+    results = benchmark(args.rows, args.engine, args.paths)
+    print(results.to_string(index=False))
+    if args.out:
+        results.insert(0, 'date', pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'))
+        results.insert(1, 'engine', args.engine)
+        results.to_csv(args.out, mode='a', index=False, header=not os.path.exists(args.out))
@@ -57,7 +57,7 @@ def td_load_df(df, dsn, table_name, index=None): #This is the main function
         pass
     cursor.execute(sql_create_statement(df, table_name_clean, guess_index(df, index)))
     cursor.executemanycolumns(sql_insert_statement(df, table_name_clean), 
-                         [df[col].values for col in df.columns])
+                         [np.asarray(df[col].values) for col in df.columns])
     connection.close()
     print("Loaded your dataframe successfully")
 
@@ -73,6 +73,7 @@ def dtypes_pd_to_td(df): #maps pandas dtypes to what
     'int16':'SMALLINT', 'int32':'INTEGER', 'int64':'BIGINT'
     ,'float16':'FLOAT', 'float32':'FLOAT', 'float64':'FLOAT'
     ,'object':'VARCHAR('+str(longest_str) + ')'
+    ,'str':'VARCHAR('+str(longest_str) + ')', 'string':'VARCHAR('+str(longest_str) + ')'
             }
     dtypes = df.dtypes.astype(str)
     if not set(dtypes).issubset(set(type_dict)):
@@ -82,8 +83,9 @@ def dtypes_pd_to_td(df): #maps pandas dtypes to what
     return zip(df.columns, [type_dict[dtype] for dtype in dtypes])
 
 def get_longest_string(df):
-    col_long_str = [df[col].str.len().max() for col in df.select_dtypes(
-        include=['object', 'category'])]
+    # pandas 3 stores strings as 'str' dtype
+    col_long_str = [df[col].str.len().max() for col in df.columns
+                    if str(df[col].dtype) in ['object', 'str', 'string', 'category']]
     return int(max(col_long_str+[0])) #returns 0 if no str columns, doesn't matter
 
 def sql_create_statement(df, table_name, index): #SQL Create Table Statement